@@ -6,6 +6,8 @@ Control Flow Graphs (CFG)
 
 import tac
 from io import StringIO
+from collections import deque
+import cfg_analysis
 
 # ------------------------------------------------------------------------------
 
@@ -73,6 +75,7 @@ class CFG:
         self._blockmap = {bl.label: bl for bl in blocks}
         self._fwd = {lab: set() for lab in self._blockmap}  # next()
         self._bwd = {lab: set() for lab in self._blockmap}  # prev()
+        self._analyses = dict()     # see cached()
         # now link up the blocks
         for bl in blocks:
             for jinstr in bl.jumps:
@@ -116,8 +119,20 @@ class CFG:
             for lab_to in self._fwd[lab_from]:
                 yield (lab_from, lab_to)
 
+    def cached(self, name, compute):
+        """Return the result of the analysis `name', computing it as
+        `compute(self)' if the graph changed since it was last computed"""
+        if name not in self._analyses:
+            self._analyses[name] = compute(self)
+        return self._analyses[name]
+
+    def invalidate(self):
+        """Forget the cached analyses; every edit of the graph calls it"""
+        self._analyses.clear()
+
     def add_node(self, block):
         assert block.label not in self._blockmap
+        self.invalidate()
         self._blockmap[block.label] = block
         self._fwd[block.label] = set()
         self._bwd[block.label] = set()
@@ -127,16 +142,22 @@ class CFG:
 
     def remove_node(self, block):
         assert block.label in self._blockmap
+        self.invalidate()
         del self._blockmap[block.label]
         for lab_to in self._fwd[block.label]:
-            self._bwd[lab_to].remove(block.label)
+            self._bwd[lab_to].discard(block.label)
+        for lab_from in self._bwd[block.label]:
+            self._fwd[lab_from].discard(block.label)
         del self._fwd[block.label]
+        del self._bwd[block.label]
 
     def add_edge(self, lab_from, lab_to):
+        self.invalidate()
         self._fwd[lab_from].add(lab_to)
         self._bwd[lab_to].add(lab_from)
 
     def remove_edge(self, lab_from, lab_to):
+        self.invalidate()
         self._fwd[lab_from].remove(lab_to)
         self._bwd[lab_to].remove(lab_from)
 
@@ -196,7 +217,7 @@ def apply_label_rewrite(jinstr, tab):
     if jinstr.opcode == 'jmp':
         jinstr.arg1 = tab.get(jinstr.arg1, jinstr.arg1)
     elif jinstr.opcode == 'phi':
-        jinstr.arg1 = tuple((tab.get(lab, lab), tmp) for (lab, tmp) in jinstr.arg1.items())
+        jinstr.arg1 = {tab.get(lab, lab): tmp for (lab, tmp) in jinstr.arg1.items()}
     elif jinstr.opcode != 'ret':
         jinstr.arg2 = tab.get(jinstr.arg2, jinstr.arg2)
 
@@ -336,44 +357,127 @@ def linearize(tac_proc, cfg):
 
 # ------------------------------------------------------------------------------
 
-def filter_liveset(lab, lset):
-    for x in lset:
-        if isinstance(x, tuple):
-            if x[0] == lab: yield x[1]
-        else: yield x
+class Liveness:
+    """Live temporaries of `cfg', as of the time of construction.
+
+    The fixpoint is computed per basic block on integers used as bitsets
+    over densely numbered temporaries, with a worklist visiting the blocks
+    in postorder. The sets of each instruction of a block are only derived
+    the first time one of them is asked for. An argument (lab, t) of a phi
+    function makes t live out of the block `lab' only.
+
+    So the livein set of a phi function holds the arguments, from every
+    predecessor, of the phi functions from it to the end of the block. Past
+    the phi functions, an argument is live like any other temporary, from
+    its definition to the jump along its edge. The liveout sets are those of
+    the former recompute_liveness, but its livein sets also counted the
+    arguments coming from the other predecessors all through a block that
+    jumps to itself (see test_liveness.py)."""
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self._index = dict()    # temporary -> bit number
+        self._temps = []        # bit number -> temporary
+        self._block_of = dict() # instr -> label of its block
+        self._use, self._def, self._phi = dict(), dict(), dict()
+        for bl in cfg.nodes():
+            use, defs, phi = 0, 0, dict()   # phi: predecessor label -> temporaries used from it
+            for instr in bl.reversed_instrs():
+                self._block_of[instr] = bl.label
+                i_uses, i_defs, i_phi = self._bits(instr)
+                use = (use & ~i_defs) | i_uses
+                defs |= i_defs
+                for lab in phi: phi[lab] &= ~i_defs
+                for lab, bits in i_phi.items(): phi[lab] = phi.get(lab, 0) | bits
+            self._use[bl.label], self._def[bl.label], self._phi[bl.label] = use, defs, phi
+
+        self._in = {lab: 0 for lab in self._use}
+        self._out = {lab: 0 for lab in self._use}
+        # a backward problem converges fastest when successors are visited first
+        order = cfg_analysis.reverse_postorder(cfg)[::-1]
+        reachable = set(order)
+        order += [bl.label for bl in cfg.nodes() if bl.label not in reachable]
+        worklist, pending = deque(order), set(order)
+        while len(worklist) > 0:
+            lab = worklist.popleft()
+            pending.remove(lab)
+            out = 0
+            for succ in cfg.successors(lab):
+                out |= self._in[succ] | self._phi[succ].get(lab, 0)
+            self._out[lab] = out
+            new_in = self._use[lab] | (out & ~self._def[lab])
+            if new_in != self._in[lab]:
+                self._in[lab] = new_in
+                for pred in cfg.predecessors(lab):
+                    if pred not in pending:
+                        pending.add(pred)
+                        worklist.append(pred)
+        self._instr_in, self._instr_out = dict(), dict()
+
+    def _bit(self, tmp):
+        if tmp not in self._index:
+            self._index[tmp] = len(self._temps)
+            self._temps.append(tmp)
+        return 1 << self._index[tmp]
+
+    def _bits(self, instr):
+        """(uses, defs, phi uses per predecessor) of `instr' as bitsets"""
+        uses, phi = 0, dict()
+        for x in instr.uses():
+            if isinstance(x, tuple): phi[x[0]] = phi.get(x[0], 0) | self._bit(x[1])
+            else: uses |= self._bit(x)
+        defs = 0
+        for x in instr.defs(): defs |= self._bit(x)
+        return uses, defs, phi
+
+    def _set(self, bits):
+        result = set()
+        while bits:
+            low = bits & -bits
+            result.add(self._temps[low.bit_length() - 1])
+            bits ^= low
+        return result
+
+    def _derive(self, lab):
+        # walk the block backwards from its live out set
+        live, phi = self._out[lab], dict()
+        for instr in self.cfg[lab].reversed_instrs():
+            self._instr_out[instr] = live | phi.get(lab, 0)
+            i_uses, i_defs, i_phi = self._bits(instr)
+            live = (live & ~i_defs) | i_uses
+            for l in phi: phi[l] &= ~i_defs
+            for l, bits in i_phi.items(): phi[l] = phi.get(l, 0) | bits
+            self._instr_in[instr] = live
+            for bits in phi.values(): self._instr_in[instr] |= bits
+
+    def livein(self, instr):
+        """Set of the temporaries live before `instr'"""
+        if instr not in self._instr_in: self._derive(self._block_of[instr])
+        return self._set(self._instr_in[instr])
+
+    def liveout(self, instr):
+        """Set of the temporaries live after `instr'"""
+        if instr not in self._instr_out: self._derive(self._block_of[instr])
+        return self._set(self._instr_out[instr])
+
+    def block_livein(self, lab):
+        """Set of the temporaries live at the start of the block `lab', not
+        counting the arguments of its phi functions"""
+        return self._set(self._in[lab])
+
+    def block_liveout(self, lab):
+        return self._set(self._out[lab])
 
 def recompute_liveness(cfg, livein, liveout):
     """Perform liveness analysis on the given cfg, storing the results in `livein' and `liveout'.
-    Note: both `livein' and `liveout' are cleaned out before computing liveness."""
+    Note: both `livein' and `liveout' are cleaned out before computing liveness.
+    Use Liveness directly to only get the sets of some instructions."""
+    live = Liveness(cfg)
     livein.clear()
     liveout.clear()
-    # initialize livein with the use sets
     for i in cfg.instrs():
-        livein[i] = set(i.uses())
-        liveout[i] = set()
-    dirty = True
-    def update_livein(i, j_livein):
-        nonlocal dirty
-        old_count = len(livein[i])
-        old_set = str(livein[i])
-        i_defs = set(i.defs())
-        for x in j_livein:
-            if ((isinstance(x, tuple) and x[1] in i_defs) or \
-                x in i_defs): continue
-            livein[i].add(x)
-        if old_count != len(livein[i]):
-            dirty = True
-    while dirty:
-        dirty = False
-        for (li, i, lj, j) in cfg.instr_pairs(labeled=True):
-            if li == lj: update_livein(i, livein[j])
-            else: update_livein(i, filter_liveset(li, livein[j]))
-    for li, i, lj, j in cfg.instr_pairs(labeled=True):
-        liveout[i].update(filter_liveset(li, livein[j]))
-    # fix the livein sets to remove tuples
-    for i, li in livein.items():
-        livein[i] = {x[1] if isinstance(x, tuple) else x \
-                     for x in li}
+        livein[i] = live.livein(i)
+        liveout[i] = live.liveout(i)
 
 # ------------------------------------------------------------------------------
 
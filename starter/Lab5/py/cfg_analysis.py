@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+"""
+Dominators and loops of a CFG
+
+The results are cached on the cfg.CFG (see CFG.cached) and recomputed after
+the graph is edited with add_node, remove_node, add_edge or remove_edge.
+Blocks that are not reachable from the entry are ignored.
+"""
+
+import tac
+import cfg as cfglib
+
+# ------------------------------------------------------------------------------
+
+def _reverse_postorder(cfg):
+    # successors are visited in sorted order so that the result does not
+    # depend on the iteration order of sets
+    order = []
+    seen = {cfg.lab_entry}
+    work = [(cfg.lab_entry, iter(sorted(cfg.successors(cfg.lab_entry))))]
+    while len(work) > 0:
+        lab, succs = work[-1]
+        for succ in succs:
+            if succ not in seen:
+                seen.add(succ)
+                work.append((succ, iter(sorted(cfg.successors(succ)))))
+                break
+        else:
+            work.pop()
+            order.append(lab)
+    order.reverse()
+    return order
+
+def reverse_postorder(cfg):
+    """List of the labels of the blocks reachable from the entry, each block
+    coming before its successors except along back edges"""
+    return cfg.cached('reverse_postorder', _reverse_postorder)
+
+# ------------------------------------------------------------------------------
+
+class Dominators:
+    """Dominator tree and dominance frontiers, with the algorithm of Cooper,
+    Harvey and Kennedy ("A Simple, Fast Dominance Algorithm")"""
+
+    def __init__(self, cfg):
+        self.rpo = reverse_postorder(cfg)
+        index = {lab: i for i, lab in enumerate(self.rpo)}
+        entry = cfg.lab_entry
+        self.idom = {entry: entry}
+
+        def intersect(b1, b2):
+            while b1 != b2:
+                while index[b1] > index[b2]: b1 = self.idom[b1]
+                while index[b2] > index[b1]: b2 = self.idom[b2]
+            return b1
+
+        changed = True
+        while changed:
+            changed = False
+            for lab in self.rpo[1:]:
+                new_idom = None
+                for pred in cfg.predecessors(lab):
+                    if pred not in self.idom: continue
+                    new_idom = pred if new_idom is None else intersect(pred, new_idom)
+                if self.idom.get(lab) != new_idom:
+                    self.idom[lab] = new_idom
+                    changed = True
+
+        self.children = {lab: [] for lab in self.rpo}
+        for lab in self.rpo[1:]:
+            self.children[self.idom[lab]].append(lab)
+        # preorder and postorder numbers in the tree, for constant time dominates()
+        self._pre, self._post = dict(), dict()
+        counter = cfglib.counter()
+        work = [(entry, iter(self.children[entry]))]
+        self._pre[entry] = next(counter)
+        while len(work) > 0:
+            lab, kids = work[-1]
+            kid = next(kids, None)
+            if kid is None:
+                work.pop()
+                self._post[lab] = next(counter)
+            else:
+                self._pre[kid] = next(counter)
+                work.append((kid, iter(self.children[kid])))
+
+        self.frontier = {lab: set() for lab in self.rpo}
+        for lab in self.rpo:
+            preds = [pred for pred in cfg.predecessors(lab) if pred in self.idom]
+            if lab == entry:
+                # the entry also joins the edge coming from the caller, so it
+                # is in the frontier of everything on the path to a back edge
+                for pred in preds:
+                    runner = pred
+                    while lab not in self.frontier[runner]:
+                        self.frontier[runner].add(lab)
+                        if runner == entry: break
+                        runner = self.idom[runner]
+                continue
+            if len(preds) < 2: continue
+            for pred in preds:
+                runner = pred
+                while runner != self.idom[lab]:
+                    self.frontier[runner].add(lab)
+                    runner = self.idom[runner]
+
+    def dominates(self, lab1, lab2):
+        """Whether every path from the entry to `lab2' goes through `lab1'"""
+        return self._pre[lab1] <= self._pre[lab2] and self._post[lab2] <= self._post[lab1]
+
+    def iterated_frontier(self, labs):
+        """The iterated dominance frontier of the set of labels `labs'"""
+        result = set()
+        work = list(labs)
+        while len(work) > 0:
+            for lab in self.frontier[work.pop()]:
+                if lab not in result:
+                    result.add(lab)
+                    work.append(lab)
+        return result
+
+def dominators(cfg):
+    return cfg.cached('dominators', Dominators)
+
+# ------------------------------------------------------------------------------
+
+class Loop:
+    """Natural loop: the header and every block that reaches one of the back
+    edges to it (the latches) without going through the header"""
+
+    def __init__(self, header):
+        self.header = header
+        self.latches = set()
+        self.blocks = {header}
+        self.parent = None      # innermost enclosing loop
+        self.children = []
+        self.depth = 1
+
+    def __repr__(self):
+        return f'Loop({self.header}, depth={self.depth}, blocks={sorted(self.blocks)})'
+
+class LoopForest:
+    """The natural loops of a CFG, nested in a forest"""
+
+    def __init__(self, cfg):
+        doms = dominators(cfg)
+        loops = dict()          # header -> Loop
+        for lab in doms.rpo:
+            for succ in cfg.successors(lab):
+                if not doms.dominates(succ, lab): continue
+                loop = loops.setdefault(succ, Loop(succ))
+                loop.latches.add(lab)
+                work = [lab]
+                while len(work) > 0:
+                    cur = work.pop()
+                    if cur in loop.blocks: continue
+                    loop.blocks.add(cur)
+                    work.extend(pred for pred in cfg.predecessors(cur) if pred in doms.idom)
+        # nest the loops, smallest first: a block belongs to the first loop that
+        # contains it, and the outermost loop found so far around it gets the
+        # current loop as parent
+        self.loop_of = dict()   # label -> innermost loop containing it
+        index = {lab: i for i, lab in enumerate(doms.rpo)}
+        for loop in sorted(loops.values(), key=lambda l: (len(l.blocks), index[l.header])):
+            for lab in loop.blocks:
+                inner = self.loop_of.get(lab)
+                if inner is None:
+                    self.loop_of[lab] = loop
+                    continue
+                while inner.parent is not None: inner = inner.parent
+                if inner is not loop:
+                    inner.parent = loop
+        self.loops = [loops[lab] for lab in doms.rpo if lab in loops]
+        self.roots = []
+        for loop in self.loops:     # parents before children
+            if loop.parent is None:
+                self.roots.append(loop)
+            else:
+                loop.parent.children.append(loop)
+                loop.depth = loop.parent.depth + 1
+
+    def depth(self, lab):
+        """Number of loops containing the block `lab'"""
+        loop = self.loop_of.get(lab)
+        return 0 if loop is None else loop.depth
+
+def loops(cfg):
+    return cfg.cached('loops', LoopForest)
+
+# ------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Dominators and loops of the procedures of a TAC file')
+    ap.add_argument('file', metavar='FILE', type=str, nargs=1, help='A TAC file')
+    args = ap.parse_args()
+    for tlv in tac.load_tac(args.file[0]):
+        if isinstance(tlv, tac.Proc):
+            cfg = cfglib.infer(tlv)
+            doms, forest = dominators(cfg), loops(cfg)
+            print(f'proc {tlv.name}:')
+            for lab in doms.rpo:
+                frontier = ', '.join(sorted(doms.frontier[lab]))
+                print(f'  {lab}: idom {doms.idom[lab]}, frontier {{{frontier}}}, loop depth {forest.depth(lab)}')
+            for loop in forest.loops:
+                print(f'  {loop}')
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+"""
+Bit-vector dataflow analyses over a CFG
+
+A problem is solved per basic block on integers used as bitsets over the
+densely numbered items of its lattice (see Numbering), with a worklist.
+The sets of single instructions are only derived when asked for.
+
+Ships with reaching definitions, available expressions and very busy
+expressions. Liveness stays in cfg.Liveness because of phi functions.
+"""
+
+import tac
+import cfg as cfglib
+import cfg_analysis
+from abc import ABC, abstractmethod
+from collections import deque
+
+# ------------------------------------------------------------------------------
+
+def union(x, y): return x | y
+
+def intersection(x, y): return x & y
+
+class Numbering:
+    """Dense numbering of the items of a lattice, one bit per item"""
+
+    def __init__(self):
+        self._index = dict()    # item -> bit number
+        self._items = []        # bit number -> item
+
+    def __len__(self):
+        return len(self._items)
+
+    def bit(self, item):
+        if item not in self._index:
+            self._index[item] = len(self._items)
+            self._items.append(item)
+        return 1 << self._index[item]
+
+    def bits(self, items):
+        result = 0
+        for item in items: result |= self.bit(item)
+        return result
+
+    def universe(self):
+        return (1 << len(self._items)) - 1
+
+    def items(self, bits):
+        """Set of the items in `bits'"""
+        result = set()
+        while bits:
+            low = bits & -bits
+            result.add(self._items[low.bit_length() - 1])
+            bits ^= low
+        return result
+
+def solve(cfg, *, forward, meet, transfer, boundary, top):
+    """Fixpoint of a dataflow problem over the blocks of `cfg'.
+
+    forward: direction of the problem
+    meet: function combining the values of two neighbours (union, intersection)
+    transfer: function (label, value on entry) -> value on exit of a block,
+      where entry and exit follow the direction of the problem
+    boundary: value flowing into the entry block (forward), or into the
+      blocks without successors (backward)
+    top: initial value of the other blocks, the identity of `meet'
+
+    Returns two dicts (before, after) from labels to the values at the
+    start and at the end of each block."""
+    order = cfg_analysis.reverse_postorder(cfg)
+    if not forward: order = order[::-1]
+    reachable = set(order)
+    order += [bl.label for bl in cfg.nodes() if bl.label not in reachable]
+    if forward: sources, sinks = cfg.predecessors, cfg.successors
+    else: sources, sinks = cfg.successors, cfg.predecessors
+    value_in = {lab: top for lab in order}
+    value_out = {lab: top for lab in order}
+    worklist, pending = deque(order), set(order)
+    while len(worklist) > 0:
+        lab = worklist.popleft()
+        pending.remove(lab)
+        value = top
+        has_source = False
+        for src in sources(lab):
+            value = meet(value, value_out[src])
+            has_source = True
+        if (lab == cfg.lab_entry) if forward else not has_source:
+            value = meet(value, boundary)
+        value_in[lab] = value
+        new_out = transfer(lab, value)
+        if new_out != value_out[lab]:
+            value_out[lab] = new_out
+            for dest in sinks(lab):
+                if dest not in pending:
+                    pending.add(dest)
+                    worklist.append(dest)
+    if forward: return value_in, value_out
+    return value_out, value_in
+
+# ------------------------------------------------------------------------------
+
+class GenKillAnalysis(ABC):
+    """Dataflow problem whose transfer function for each instruction is
+    x -> gen | (x & ~kill).
+
+    Subclasses set `forward' and `meet', and define genkill(instr), giving
+    the bitsets (gen, kill) of an instruction over self.items, and
+    boundary(), the value at the boundary of the procedure. The items must
+    all be numbered before the fixpoint is computed, since the initial
+    value of an intersection problem is the universe."""
+
+    forward = True
+    meet = staticmethod(union)
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.items = Numbering()
+        self._number_items()
+        self._genkill = dict()  # instr -> (gen, kill)
+        self._block_of = dict() # instr -> label of its block
+        self._gen, self._kill = dict(), dict()
+        for bl in cfg.nodes():
+            gen, kill = 0, 0
+            for instr in self._ordered(bl):
+                self._block_of[instr] = bl.label
+                i_gen, i_kill = self._genkill[instr] = self.genkill(instr)
+                gen = i_gen | (gen & ~i_kill)
+                kill |= i_kill
+            self._gen[bl.label], self._kill[bl.label] = gen, kill
+        top = 0 if self.meet is union else self.items.universe()
+        self._before, self._after = solve(
+            cfg, forward=self.forward, meet=self.meet,
+            transfer=lambda lab, x: self._gen[lab] | (x & ~self._kill[lab]),
+            boundary=self.boundary(), top=top)
+        self._instr_before, self._instr_after = dict(), dict()
+
+    def _number_items(self):
+        pass
+
+    @abstractmethod
+    def genkill(self, instr):
+        """The bitsets (gen, kill) of `instr' over self.items"""
+
+    def boundary(self):
+        return 0
+
+    def _ordered(self, bl):
+        """Instructions of `bl' in the direction of the problem"""
+        return bl.instrs() if self.forward else bl.reversed_instrs()
+
+    def _derive(self, lab):
+        if self.forward: value, here, there = self._before[lab], self._instr_before, self._instr_after
+        else: value, here, there = self._after[lab], self._instr_after, self._instr_before
+        for instr in self._ordered(self.cfg[lab]):
+            here[instr] = value
+            gen, kill = self._genkill[instr]
+            value = gen | (value & ~kill)
+            there[instr] = value
+
+    def before(self, instr):
+        """Set of the items holding just before `instr'"""
+        if instr not in self._instr_before: self._derive(self._block_of[instr])
+        return self.items.items(self._instr_before[instr])
+
+    def after(self, instr):
+        """Set of the items holding just after `instr'"""
+        if instr not in self._instr_after: self._derive(self._block_of[instr])
+        return self.items.items(self._instr_after[instr])
+
+    def block_before(self, lab):
+        return self.items.items(self._before[lab])
+
+    def block_after(self, lab):
+        return self.items.items(self._after[lab])
+
+# ------------------------------------------------------------------------------
+
+class ReachingDefinitions(GenKillAnalysis):
+    """Instructions defining a temporary whose value may reach a point"""
+
+    forward = True
+    meet = staticmethod(union)
+
+    def _number_items(self):
+        self._defs_of = dict()  # temporary -> bits of the instructions defining it
+        for instr in self.cfg.instrs():
+            for t in instr.defs():
+                self._defs_of[t] = self._defs_of.get(t, 0) | self.items.bit(instr)
+
+    def genkill(self, instr):
+        gen, kill = 0, 0
+        for t in instr.defs():
+            gen = self.items.bit(instr)
+            kill |= self._defs_of[t]
+        return gen, kill & ~gen
+
+# ------------------------------------------------------------------------------
+
+# pure operators, whose result only depends on their arguments
+expr_opcodes = frozenset(op for op, kind in tac.opcode_kinds.items() \
+                         if kind in ('VVV', 'VVN') and op != 'copy')
+
+def expression(instr):
+    """The expression (opcode, arg1, arg2) computed by `instr', or None.
+    Only the expressions over temporaries count, since a global can be
+    changed by any call."""
+    if instr.opcode not in expr_opcodes: return None
+    for arg in (instr.arg1, instr.arg2):
+        if arg is not None and not tac.Instr._istemp(arg): return None
+    return (instr.opcode, instr.arg1, instr.arg2)
+
+class _ExpressionAnalysis(GenKillAnalysis):
+    meet = staticmethod(intersection)
+
+    def _number_items(self):
+        self._exprs_of = dict() # temporary -> bits of the expressions using it
+        for instr in self.cfg.instrs():
+            e = expression(instr)
+            if e is None: continue
+            for arg in e[1:]:
+                if arg is None: continue
+                self._exprs_of[arg] = self._exprs_of.get(arg, 0) | self.items.bit(e)
+
+    def _killed(self, instr):
+        kill = 0
+        for t in instr.defs(): kill |= self._exprs_of.get(t, 0)
+        return kill
+
+class AvailableExpressions(_ExpressionAnalysis):
+    """Expressions computed on every path to a point, with none of their
+    arguments redefined since"""
+
+    forward = True
+
+    def genkill(self, instr):
+        kill = self._killed(instr)
+        e = expression(instr)
+        gen = 0 if e is None else self.items.bit(e) & ~kill
+        return gen, kill
+
+class VeryBusyExpressions(_ExpressionAnalysis):
+    """Expressions computed on every path from a point, before any of their
+    arguments is redefined"""
+
+    forward = False
+
+    def genkill(self, instr):
+        kill = self._killed(instr)
+        e = expression(instr)
+        gen = 0 if e is None else self.items.bit(e)
+        return gen, kill & ~gen
+
+# ------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Dataflow analyses of the procedures of a TAC file')
+    ap.add_argument('file', metavar='FILE', type=str, nargs=1, help='A TAC file')
+    args = ap.parse_args()
+    def show(items):
+        return ', '.join(sorted(str(item).strip() for item in items))
+    for tlv in tac.load_tac(args.file[0]):
+        if isinstance(tlv, tac.Proc):
+            cfg = cfglib.infer(tlv)
+            reaching, avail, busy = ReachingDefinitions(cfg), \
+                AvailableExpressions(cfg), VeryBusyExpressions(cfg)
+            print(f'proc {tlv.name}:')
+            for bl in cfg.nodes():
+                print(f'{bl.label}:')
+                for instr in bl.instrs():
+                    print(instr)
+                    print(f'    reaching {{{show(reaching.after(instr))}}}')
+                    print(f'    available {{{show(avail.after(instr))}}}')
+                    print(f'    very busy {{{show(busy.before(instr))}}}')
@@ -2,42 +2,45 @@
 
 import tac
 import cfg as cfglib
-import re, random, os
+import cfg_analysis
+import random, os
 
 # ------------------------------------------------------------------------------
 # liveness
 
-_arg1_use = re.compile(r'add|sub|mul|div|mod|neg|and|or|xor|not|shl|shr|copy|ret|jz|jnz|jl|jle|jnl|jnle')
-_arg2_use = re.compile(r'add|sub|mul|div|mod|and|or|xor|shl|shr|param')
-_dest_def = re.compile(r'add|sub|mul|div|mod|neg|and|or|xor|not|shl|shr|const|copy|phi|call')
+# the opcodes reading arg1 or arg2, and writing dest, from their argument
+# kinds in tac.opcode_kinds (the arguments of phi are handled separately)
+_arg1_use = frozenset(op for op, kind in tac.opcode_kinds.items() if kind[1] in 'VO')
+_arg2_use = frozenset(op for op, kind in tac.opcode_kinds.items() if kind[2] in 'VO')
+_dest_def = frozenset(op for op, kind in tac.opcode_kinds.items() if kind[0] in 'VO')
 
 def use_set(instr):
     s = set()
-    if _arg1_use.fullmatch(instr.opcode) and instr.arg1: s.add(instr.arg1)
-    if _arg2_use.fullmatch(instr.opcode) and instr.arg2: s.add(instr.arg2)
+    if instr.opcode in _arg1_use and instr.arg1: s.add(instr.arg1)
+    if instr.opcode in _arg2_use and instr.arg2: s.add(instr.arg2)
     if instr.opcode == 'phi': s.update(instr.arg1.values())
     return s
 
 def rewrite_use_temps_nonphi(instr, fn):
-    if _arg1_use.fullmatch(instr.opcode) and instr.arg1:
+    if instr.opcode in _arg1_use and instr.arg1:
         instr.arg1 = fn(instr.arg1)
-    if _arg2_use.fullmatch(instr.opcode) and instr.arg2:
+    if instr.opcode in _arg2_use and instr.arg2:
         instr.arg2 = fn(instr.arg2)
 
 def def_set(instr):
     s = set()
-    if _dest_def.fullmatch(instr.opcode) and instr.dest: s.add(instr.dest)
+    if instr.opcode in _dest_def and instr.dest: s.add(instr.dest)
     return s
 
 def rewrite_temps(instr, fn):
-    if _arg1_use.fullmatch(instr.opcode) and instr.arg1:
+    if instr.opcode in _arg1_use and instr.arg1:
         instr.arg1 = fn(instr.arg1)
-    if _arg2_use.fullmatch(instr.opcode) and instr.arg2:
+    if instr.opcode in _arg2_use and instr.arg2:
         instr.arg2 = fn(instr.arg2)
     if instr.opcode == 'phi':
         for l, t in instr.arg1.items():
             instr.arg1[l] = fn(t)
-    if _dest_def.fullmatch(instr.opcode) and instr.dest:
+    if instr.opcode in _dest_def and instr.dest:
         instr.dest = fn(instr.dest)
 
 # ------------------------------------------------------------------------------
@@ -52,11 +55,10 @@ def tmp_version(tmp):
     except ValueError: return ''
 
 def crude_ssagen(tlv, cfg):
-    livein, liveout = dict(), dict()
-    cfglib.recompute_liveness(cfg, livein, liveout)
+    live = cfglib.Liveness(cfg)
     for bl in cfg.nodes():
         prev_labs = list(cfg.predecessors(bl.label))
-        ts = livein[bl.first_instr()]
+        ts = live.livein(bl.first_instr())
         if bl.label == cfg.lab_entry: prev_labs.append(cfg.proc_name)
         if len(prev_labs) == 0: prev_labs = [cfg.proc_name]
         bl.body[:0] = [tac.Instr(t, 'phi', ({l: t for l in prev_labs}, None)) \
@@ -79,6 +81,64 @@ def crude_ssagen(tlv, cfg):
             for lab_prev, root in instr.arg1.items():
                 instr.arg1[lab_prev] = ver_maps[lab_prev].get(root, root)
 
+# ------------------------------------------------------------------------------
+# pruned SSA gen (Cytron et al.)
+
+def ssagen(tlv, cfg):
+    """Put the procedure in SSA form: the phi functions of a temporary go on
+    the iterated dominance frontier of the blocks that define it, but only
+    where the temporary is live, and the temporaries are then renamed on a
+    walk of the dominator tree. A use that no definition reaches keeps the
+    original name, as do the arguments of the procedure."""
+    doms = cfg_analysis.dominators(cfg)
+    live = cfglib.Liveness(cfg)
+    # the entry defines every temporary, with the value it has on entry
+    defsites = dict()
+    for lab in doms.rpo:
+        for instr in cfg[lab].instrs():
+            for t in instr.defs():
+                defsites.setdefault(t, {cfg.lab_entry}).add(lab)
+    livein = dict()
+    for t in sorted(defsites):
+        for lab in sorted(doms.iterated_frontier(defsites[t])):
+            if lab not in livein: livein[lab] = live.block_livein(lab)
+            if t not in livein[lab]: continue
+            prev_labs = list(cfg.predecessors(lab))
+            if lab == cfg.lab_entry: prev_labs.append(cfg.proc_name)
+            cfg[lab].body.insert(0, tac.Instr(t, 'phi', ({l: t for l in prev_labs}, None)))
+
+    versions = cfglib.counter(transfn=lambda x: f'.{x}')
+    stacks = dict()             # original temporary -> its visible versions
+    def current(t):
+        stack = stacks.get(t)
+        return stack[-1] if stack else t
+    def rename_block(lab):
+        pushed = []
+        for instr in cfg[lab].instrs():
+            if instr.opcode != 'phi':
+                rewrite_use_temps_nonphi(instr, current)
+            for t in instr.defs():
+                instr.dest = t + next(versions)
+                stacks.setdefault(t, []).append(instr.dest)
+                pushed.append(t)
+        for succ in cfg.successors(lab):
+            for instr in cfg[succ].body:
+                if instr.opcode != 'phi': break
+                instr.arg1[lab] = current(instr.arg1[lab])
+        return pushed
+
+    reachable = set(doms.rpo)
+    roots = [cfg.lab_entry] + [bl.label for bl in cfg.nodes() if bl.label not in reachable]
+    for root in roots:
+        work = [(root, None)]
+        while len(work) > 0:
+            lab, pushed = work.pop()
+            if pushed is not None:
+                for t in pushed: stacks[t].pop()
+                continue
+            work.append((lab, rename_block(lab)))
+            if lab in reachable:
+                work.extend((kid, None) for kid in reversed(doms.children[lab]))
 
 # ------------------------------------------------------------------------------
 
@@ -105,7 +165,7 @@ if __name__ == '__main__':
     for tlv in tac.load_tac(args.file[0]):
         if isinstance(tlv, tac.Proc):
             cfg = cfglib.infer(tlv)
-            crude_ssagen(tlv, cfg)
+            ssagen(tlv, cfg)
             make_dotfiles(cfg, tlv.name[1:], args.file[0], args.verbosity)
             if args.verbosity >= 2:
                 cfglib.linearize(tlv, cfg)
@@ -5,40 +5,40 @@ import sys
 import json
 
 # ------------------------------------------------------------------------------
-# Global Dead Store Elimination (DSE)
-
-def dead_store_elimination(cfg):
-    livein, liveout = dict(), dict()
-    cfglib.recompute_liveness(cfg, livein, liveout)
-    found = False
-    # print('# ------------------------------------------------------------------------------')
-
-    for bl in cfg._blockmap.values():
-        to_remove = []
-        for i,instr in enumerate(bl.body):
-            # print(instr.opcode, instr.dest, liveout[instr])
-            if instr.opcode not in ['div','mod','call','param'] and instr.dest not in liveout[instr]:
-                to_remove.append(i)
-                # print('found')
-                found = True
-
-        # if len(to_remove) != 0:
-        #     print(f'Removed {len(to_remove)} instructions: {to_remove}')
-        for i in reversed(to_remove):
-            bl.body.pop(i)
-
-    cfglib.recompute_liveness(cfg, livein, liveout)
-    if found:
-        dead_store_elimination(cfg)
-
-
-
+# Global Dead Code Elimination (DCE)
+
+# instructions kept for their effect; div and mod may raise on zero
+_critical = frozenset(('call', 'param', 'ret', 'div', 'mod'))
+
+def dead_code_elimination(cfg):
+    """Remove the instructions whose result is never needed, by marking the
+    instructions with an effect and, through the def-use chains, everything
+    they read; the rest is swept in one pass. The jumps are always kept.
+    Meant for SSA form, where each temporary has a single definition; with
+    several, all of them are kept when the temporary is used."""
+    defs = dict()               # temporary -> instructions defining it
+    work = []
+    for bl in cfg.nodes():
+        work.extend(bl.jumps)
+        for instr in bl.body:
+            for t in ssagenlib.def_set(instr): defs.setdefault(t, []).append(instr)
+            if instr.opcode in _critical or taclib.Instr._isglobal(instr.dest):
+                work.append(instr)
+    live = set(work)
+    while len(work) > 0:
+        for t in ssagenlib.use_set(work.pop()):
+            for instr in defs.get(t, ()):
+                if instr not in live:
+                    live.add(instr)
+                    work.append(instr)
+    for bl in cfg.nodes():
+        bl.body = [instr for instr in bl.body if instr in live]
 
 # ------------------------------------------------------------------------------
 # Copy Propagation
 
 def gcp(proc : taclib.Proc, cfg: cfglib.CFG):
-    ssagenlib.crude_ssagen(proc, cfg)
+    ssagenlib.ssagen(proc, cfg)
     refs = {}
     for bl in cfg._blockmap.values():
         to_remove = []
@@ -59,44 +59,72 @@ def gcp(proc : taclib.Proc, cfg: cfglib.CFG):
 # ------------------------------------------------------------------------------
 # Destructing SSA
 
+def sequentialize(copies, fresh):
+    """Order the parallel copies `copies', a list of (dest, src) with distinct
+    dests, into a list of sequential ones. A cycle of copies is broken by
+    saving one of its temporaries in `fresh()'."""
+    pending = {dest: src for dest, src in copies if dest != src}
+    readers = dict()            # location -> number of pending copies reading it
+    for src in pending.values(): readers[src] = readers.get(src, 0) + 1
+    ready = [dest for dest in pending if readers.get(dest, 0) == 0]
+    result = []
+    while len(pending) > 0:
+        while len(ready) > 0:
+            dest = ready.pop()
+            src = pending.pop(dest)
+            result.append((dest, src))
+            readers[src] -= 1
+            if readers[src] == 0 and src in pending: ready.append(src)
+        if len(pending) == 0: break
+        # only cycles are left, where every location is read exactly once:
+        # save the source of one copy, which frees it to be overwritten
+        dest = next(iter(pending))
+        src, tmp = pending[dest], fresh()
+        result.append((tmp, src))
+        pending[dest] = tmp
+        readers[tmp], readers[src] = 1, 0
+        ready.append(src)
+    return result
+
+def destruct_cfg(cfg):
+    """Replace the phi functions of `cfg' by copies at the end of the
+    predecessors, splitting the critical edges first so that the copies only
+    run along the edge of their phi argument"""
+    labels = cfglib.counter(transfn=lambda x: f'%.L{cfg.proc_name[1:]}.ssa{x}')
+    temps = cfglib.counter(transfn=lambda x: f'%.ssa{x}')
+    copies = dict()             # label -> parallel copies at the end of the block
+    for bl in list(cfg.nodes()):
+        phis = 0
+        while phis < len(bl.body) and bl.body[phis].opcode == 'phi': phis += 1
+        if phis == 0: continue
+        for pred in list(cfg.predecessors(bl.label)):
+            edge_lab = pred
+            if cfg.out_degree(pred) > 1:
+                edge_lab = next(labels)
+                for jinstr in cfg[pred].jumps:
+                    cfglib.apply_label_rewrite(jinstr, {bl.label: edge_lab})
+                cfg.add_node(cfglib.Block(edge_lab, jumps=[taclib.Instr(None, 'jmp', (bl.label, None))]))
+                cfg.remove_edge(pred, bl.label)
+                cfg.add_edge(pred, edge_lab)
+            copies[edge_lab] = [(phi.dest, phi.arg1[pred]) for phi in bl.body[:phis]]
+        if bl.label == cfg.lab_entry:
+            # the arguments coming from the caller are copied in a new entry
+            entry = cfglib.Block(next(labels), jumps=[taclib.Instr(None, 'jmp', (bl.label, None))])
+            cfg.add_node(entry)
+            cfg.lab_entry = entry.label
+            copies[entry.label] = [(phi.dest, phi.arg1[cfg.proc_name]) \
+                                   for phi in bl.body[:phis] if cfg.proc_name in phi.arg1]
+        del bl.body[:phis]
+    for lab, pcopies in copies.items():
+        cfg[lab].body.extend(taclib.Instr(dest, 'copy', (src, None)) \
+                             for dest, src in sequentialize(pcopies, lambda: next(temps)))
+
 def destruct(tac):
-    phi = dict()
     for decl in tac:
         if type(decl) != taclib.Proc: continue
-        for instruction in decl.body:
-            if instruction.opcode != 'phi': continue
-            for label, x in instruction.arg1.items():
-                if label not in phi.keys():
-                    phi[label]=[]
-                phi[label].append((instruction.dest, x))
-    found = True
-    while found:
-        found = False
-        for decl in tac:
-            if type(decl) != taclib.Proc: continue
-            for i, instruction in enumerate(decl.body):
-                if instruction.opcode == 'label'  and instruction.arg1 in phi.keys():
-                    j = i
-                    while decl.body[j].opcode not in taclib.jumps and decl.body[j].opcode != 'ret':
-
-                        j +=1
-                    for dest, arg in phi[instruction.arg1]:
-                        decl.body.insert(j,taclib.Instr(dest, 'copy', [arg]))
-                    del phi[instruction.arg1]
-                    found = True
-                    break
-            if found: break
-    found = True
-    while found:
-        found = False
-        for decl in tac:
-            if type(decl) != taclib.Proc: continue
-            for i, instruction in enumerate(decl.body):
-                if instruction.opcode != 'phi': continue
-                decl.body.pop(i)
-                found = True
-                break
-            if found: break
+        cfg = cfglib.infer(decl)
+        destruct_cfg(cfg)
+        cfglib.linearize(decl, cfg)
 
 # ------------------------------------------------------------------------------
 def run(tac):
@@ -130,8 +158,7 @@ if __name__ == "__main__":
             cfg = cfglib.infer(proc)
             tmp = taclib.Proc(name, t_args, body)
             gcp(tmp, cfg)
-            dead_store_elimination(cfg)
-            dead_store_elimination(cfg)
+            dead_code_elimination(cfg)
             cfglib.linearize(tmp, cfg)
             opt_tac.append(tmp)
         # destruct(opt_tac)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+"""
+Liveness around the phi functions of a block that jumps to itself
+
+Runs with pytest, or on its own.
+"""
+
+import os
+import tac
+import cfg as cfglib
+import ssagen
+
+SWAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples', 'swap.tac')
+
+def swap_loop():
+    """The CFG of @main in swap.tac in crude SSA form, and the label of the
+    loop, whose block jumps to itself"""
+    proc = next(tlv for tlv in tac.load_tac(SWAP) if isinstance(tlv, tac.Proc))
+    cfg = cfglib.infer(proc)
+    ssagen.crude_ssagen(proc, cfg)
+    loop = next(bl.label for bl in cfg.nodes() if bl.label in cfg.successors(bl.label))
+    return cfg, loop
+
+def test_phi_arguments():
+    cfg, loop = swap_loop()
+    livein, liveout = dict(), dict()
+    cfglib.recompute_liveness(cfg, livein, liveout)
+    body = list(cfg[loop].instrs())
+    phis = [instr for instr in body if instr.opcode == 'phi']
+    assert len(phis) > 0
+    for i, phi in enumerate(phis):
+        # before a phi function, the arguments of the phi functions from it on
+        # are live, whichever predecessor they come from
+        for later in phis[i:]:
+            assert set(later.arg1.values()) <= livein[phi]
+    for pred in cfg.predecessors(loop):
+        args = {phi.arg1[pred] for phi in phis}
+        assert args <= liveout[cfg[pred].last_instr()]
+        # an argument is only live on the edge from its predecessor, the
+        # former recompute_liveness let those from the entry leak around the
+        # back edge into the rest of the loop
+        if pred == loop: continue
+        for instr in body[len(phis):]:
+            assert args.isdisjoint(livein[instr])
+
+if __name__ == '__main__':
+    test_phi_arguments()
+    print('ok')
@@ -0,0 +1,86 @@
+#! /usr/bin/env python3
+
+#--------- CFG benchmark ---------#
+# Times CFG.run on generated procedures of increasing size, so that the
+# scaling of the simplification passes shows: the time per block should
+# stay roughly flat as the number of blocks grows.
+
+import copy
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from bxlib.bxerrors import Reporter
+from bxlib.bxcompiler import Compiler
+from bxlib.bxcfg import CFG
+
+# statements exercising each pass: short-circuit conditions leave useless
+# blocks, nested tests of the same condition (possibly with the operands
+# swapped) can be threaded, loop bodies are coalesced
+units = [
+    'if (x < {i} && y > {i}) {{ x = x + 1; }} else {{ y = y - 1; }}',
+    'if (x < {i}) {{ if (x < {i}) {{ y = y + 1; }} else {{ y = y - 2; }} }}',
+    'if (y < {i}) {{ if ({i} < y) {{ print(1); }} else {{ print(2); }} }}',
+    'while (x > {i}) {{ x = x - 1; if (x == {i}) {{ break; }} }}',
+    'if (!(y == {i} || x >= {i})) {{ x = x ^ y; }}',
+]
+
+def generate(n):
+    """A BX program whose main has `n' statements from `units'"""
+    lines = ['def main() {', '    var x = 0 : int;', '    var y = 0 : int;']
+    lines += ['    ' + units[i % len(units)].format(i=i) for i in range(n)]
+    lines += ['    print(x + y);', '    return;', '}']
+    return '\n'.join(lines) + '\n'
+
+def lower(source):
+    """The unoptimised TAC of `source'"""
+    reporter = Reporter()
+    tac_out = {}
+    Compiler(0).compile(reporter, source, tac_out)
+    assert reporter.error_number == 0, reporter.errors
+    return tac_out['tac']
+
+def output(source, opt_level, workdir):
+    """What `source' prints, and its exit status, once compiled with bxc.py
+    at `opt_level'"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    name = os.path.join(workdir, f'bench{opt_level}')
+    with open(name + '.bx', 'w') as f:
+        f.write(source)
+    subprocess.run([sys.executable, os.path.join(here, 'bxc.py'), f'-O{opt_level}', name + '.bx'], check=True)
+    subprocess.run(['gcc', '-o', name + '.exe', name + '.x64-linux.s',
+                    os.path.join(here, 'bxlib', 'bx_runtime.c')], check=True, stderr=subprocess.DEVNULL)
+    result = subprocess.run([name + '.exe'], capture_output=True)
+    return result.stdout, result.returncode
+
+if __name__ == "__main__":
+    ap = ArgumentParser(description='Time the CFG simplification on large generated procedures')
+    ap.add_argument('sizes', metavar='N', type=int, nargs='*', default=[500, 1000, 2000, 4000, 8000],
+                    help='numbers of statements of the generated procedures')
+    ap.add_argument('-O', dest='opt_level', type=int, choices=[1, 2], default=2, help='optimisation level')
+    ap.add_argument('-n', dest='runs', type=int, default=3, help='runs per size (the best one is kept)')
+    ap.add_argument('--check', action='store_true',
+                    help='also run each program compiled at -O0 and at -O<n>, and compare their output (needs gcc)')
+    args = ap.parse_args()
+
+    print(f'{"statements":>10}{"blocks":>10}{"after":>10}{"time (ms)":>12}{"us/block":>10}')
+    for n in args.sizes:
+        tac = lower(generate(n))
+        best = None
+        for _ in range(args.runs):
+            data = copy.deepcopy(tac)
+            cfg = CFG(Reporter(), args.opt_level)
+            start = time.perf_counter()
+            cfg.run(data)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        before, after = cfg.block_counts['main']
+        line = f'{n:>10}{before:>10}{after:>10}{1000 * best:>12.1f}{1e6 * best / before:>10.1f}'
+        if args.check:
+            with tempfile.TemporaryDirectory() as workdir:
+                same = output(generate(n), 0, workdir) == output(generate(n), args.opt_level, workdir)
+            line += '  same output' if same else '  OUTPUT DIFFERS'
+        print(line)
@@ -0,0 +1,46 @@
+#! /usr/bin/env python3
+
+#--------- Startup benchmark ---------#
+# Times `bxc.py FILE` with a cold parse table cache (tables rebuilt by ply)
+# against a warm one (tables loaded from bxlib.bxparser.PARSETAB_CACHE).
+
+import os
+import sys
+import time
+import subprocess
+from argparse import ArgumentParser
+
+from bxlib.bxparser import PARSETAB_CACHE
+
+
+def time_run(cmd):
+    start = time.perf_counter()
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def clear_cache():
+    try:
+        os.remove(PARSETAB_CACHE)
+    except FileNotFoundError:
+        pass
+
+
+if __name__ == "__main__":
+    ap = ArgumentParser(description='Cold versus warm bxc.py start time')
+    ap.add_argument('file', metavar='FILE', type=str, nargs='?', default='examples/lab1_print42.bx',
+                    help='A BX source file (default: examples/lab1_print42.bx)')
+    ap.add_argument('-n', dest='runs', type=int, default=10, help='runs per configuration')
+    args = ap.parse_args()
+
+    cmd = [sys.executable, 'bxc.py', args.file]
+    cold, warm = [], []
+    for _ in range(args.runs):
+        clear_cache()
+        cold.append(time_run(cmd))
+        warm.append(time_run(cmd))
+    # leave the cache warm for the next compilation, but drop the assembly
+    os.remove(f'{args.file[:-3]}.x64-linux.s')
+    for name, times in (('cold', cold), ('warm', warm)):
+        times.sort()
+        print(f'{name}: min {1000 * times[0]:7.1f} ms   median {1000 * times[len(times) // 2]:7.1f} ms')
+    print(f'speedup (median): {cold[len(cold) // 2] / warm[len(warm) // 2]:.2f}x')
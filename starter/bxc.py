@@ -1,18 +1,17 @@
 #! /usr/bin/env python3
 
 #--------- Main ---------#
+import os
 import sys
 import json
+import traceback
+from argparse import ArgumentParser
+from itertools import repeat
 
-from bxlib.bxparser import Parser
-from bxlib.bxlexer import Lexer
 from bxlib.bxerrors import Reporter
-from bxlib.bxast import *
-# from bxlib.bxsyntaxchecker import *
-from bxlib.bxtac import *
-from bxlib.bxtypechecker import *
-from bxlib.bx64 import *
-from bxlib.bxcfg import *
+from bxlib.bxcache import CompileCache
+from bxlib.bxstats import PassStats, format_table
+from bxlib import bxserver
 
 
 def read_file_to_string(file_path):
@@ -24,68 +23,179 @@ def read_file_to_string(file_path):
         return f"Error: The file '{file_path}' does not exist."
 
 
-def run_compiler(reporter, content, basename, debug=False):
-    lexer = Lexer(reporter)
-    parser = Parser(reporter)
+# Compilers of this process by optimisation level, built on first use and then
+# reused for every file (each -j worker builds its own in init_worker)
+compilers = {}
+
+def get_compiler(opt_level):
+    if opt_level not in compilers:
+        # imported on demand so that --client and cache hits stay cheap to start
+        from bxlib.bxcompiler import Compiler
+        compilers[opt_level] = Compiler(opt_level)
+    return compilers[opt_level]
 
-    reporter.stage = 'Parsing'
-    ast = parser.parser.parse(content, lexer=lexer.lexer)
-    if reporter.error_number != 0:
-        return
-    if ast is None:
-        if debug: print("Error: Parsing returned None.")
-        return
-    if debug: print('Parsing successfull')
-
-    # reporter.stage = 'Syntax Check'
-    # syntax_checker = SyntaxChecker(reporter=reporter)
-    # syntax_checker.for_program(ast)
-    # if reporter.error_number != 0:
-    #     return
-    # if debug: print('Syntax Check successfull')
-
-    reporter.stage = 'Type Check'
-    type_checker = TypeChecker(reporter=reporter)
-    type_checker.for_program(ast)
-    if reporter.error_number != 0:
-        return
-    if debug: print('Type Check successfull')
-    if debug: 
-        print(ast)
 
-    reporter.stage = "Transforming AST to TAC"
-    totac = ToTac(type_checker.functions, reporter)
-    totac.processProgram(ast)
+def write_outputs(basename, asm, tac, opt_tac, emit_asm=False):
+    if tac is not None:
+        with open(f'{basename}.tac.json', 'w') as f:
+            json.dump(tac, f)
+    if opt_tac is not None:
+        with open(f'{basename}.opt.tac.json', 'w') as f:
+            json.dump(opt_tac, f)
+    if asm is not None:
+        with open(f'{basename}.x64-linux.s', 'w') as f:
+            f.write(asm)
+        if emit_asm:
+            with open(f'{basename}.s', 'w') as f:
+                f.write(asm)
+
+
+def run_compiler(file_path, content, opt_level, emit_tac=False, cache=None, time_passes=False, pass_memory=False):
+    """Compile `content' in this process, reusing the assembly of the unchanged
+    procedures found in `cache'. Returns (status, diagnostics, asm, tac, opt_tac, stats)
+    where stats is the PassStats.as_dict() of the compilation if `time_passes',
+    with the peak memory of a second, full compilation if `pass_memory'"""
+    reporter = Reporter()
+    reporter.filename = file_path
+    tac_out = {} if emit_tac else None
+    stats = PassStats(file_path) if time_passes else None
+    compiler = get_compiler(opt_level)
+    asm = compiler.compile(reporter, content, tac_out, cache, stats)
+    if stats is not None and pass_memory and reporter.error_number == 0:
+        stats.measure_memory(lambda traced: compiler.compile(Reporter(), content, stats=traced))
+    tac_out = tac_out or {}
+    stats = stats.as_dict() if stats is not None else None
     if reporter.error_number != 0:
-        return
-    data = totac.getData()
-    with open(f'{basename}.tac.json', 'w') as f:
-        json.dump(data, f)
+        diagnostics = {'stage': reporter.stage, 'errors': reporter.errors, 'message': reporter.summary()}
+        return 1, diagnostics, None, tac_out.get('tac'), tac_out.get('opt_tac'), stats
+    return 0, None, asm, tac_out.get('tac'), tac_out.get('opt_tac'), stats
 
-    reporter.stage = "CFG"
-    cfg = CFG(reporter)
-    data = cfg.run(data)
-    
-    with open(f'{basename}.opt.tac.json', 'w') as f:
-        json.dump(data, f)
 
-    reporter.stage = "TAC to x64"
-    tox64 = Tox64(reporter)
-    tox64.compile_tac(f'{basename}.tac.json')
-    
+def run_compiler_on_server(server, file_path, content, opt_level, emit_tac=False, time_passes=False,
+                           pass_memory=False):
+    """Like run_compiler, but on the compile server listening on `server'.
+    Returns None if the server cannot be reached."""
+    payload = {'filename': file_path, 'source': content, 'opt_level': opt_level, 'emit_tac': emit_tac,
+               'time_passes': time_passes, 'pass_memory': pass_memory}
+    try:
+        response = bxserver.request(server, payload)
+    except OSError:
+        return None
+    return (response['status'], response['diagnostics'], response['asm'], response['tac'], response['opt_tac'],
+            response.get('stats'))
 
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: ./myprogram.py <filename>")
-    else:
-        file_path = sys.argv[1]
+def compile_file(file_path, opt_level, emit_tac, emit_asm, cache=None, server=None, time_passes=False,
+                 pass_memory=False):
+    """Compile one file. Returns (exit status, diagnostics, stats) where diagnostics
+    is None on success or a dict with the failing stage, the raw errors and the
+    message to show the user, and stats the pass statistics if `time_passes'
+    (None when the assembly came from the cache)"""
+    try:
         content = read_file_to_string(file_path)
         if content.startswith("Error:"):
-            print(content)
-        else:
-            source = file_path[:-3]
-            reporter = Reporter()
-            reporter.filename = file_path
-            run_compiler(reporter, content, source, False)
-            reporter.describe()
+            return 1, {'stage': None, 'errors': [], 'message': content}, None
+        key = None
+        if cache is not None:
+            key = cache.key(content, opt_level)
+            # only the assembly is cached, --emit-tac needs a real compilation
+            asm = None if emit_tac else cache.get(key)
+            if asm is not None:
+                write_outputs(file_path[:-3], asm, None, None, emit_asm)
+                return 0, None, None
+        result = None
+        if server is not None:
+            result = run_compiler_on_server(server, file_path, content, opt_level, emit_tac, time_passes,
+                                            pass_memory)
+        if result is None:
+            result = run_compiler(file_path, content, opt_level, emit_tac, cache, time_passes, pass_memory)
+        status, diagnostics, asm, tac, opt_tac, stats = result
+        if key is not None and asm is not None:
+            cache.put(key, asm)
+        write_outputs(file_path[:-3], asm, tac, opt_tac, emit_asm)
+        return status, diagnostics, stats
+    except Exception:
+        return 1, {'stage': None, 'errors': [], 'message': traceback.format_exc()}, None
+
+
+def init_worker(opt_level):
+    get_compiler(opt_level)
+
+def compile_all(files, opt_level, emit_tac, emit_asm, jobs, cache=None, server=None, time_passes=False,
+                pass_memory=False):
+    """Compile `files' over `jobs' processes, or through the compile server
+    listening on `server', yielding (file, status, diagnostics, stats) in input order"""
+    if jobs == 1 or len(files) == 1 or server is not None:
+        for file_path in files:
+            yield (file_path, *compile_file(file_path, opt_level, emit_tac, emit_asm, cache, server, time_passes,
+                                            pass_memory))
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    chunksize = max(1, len(files) // (4 * jobs))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(opt_level,)) as pool:
+        results = pool.map(compile_file, files, repeat(opt_level), repeat(emit_tac), repeat(emit_asm),
+                           repeat(cache), repeat(None), repeat(time_passes), repeat(pass_memory),
+                           chunksize=chunksize)
+        for file_path, (status, diagnostics, stats) in zip(files, results):
+            yield file_path, status, diagnostics, stats
+
+
+if __name__ == "__main__":
+    ap = ArgumentParser(description='BX compiler', fromfile_prefix_chars='@')
+    ap.add_argument('files', metavar='FILE', type=str, nargs='*',
+                    help='BX source files; @LIST reads more arguments from LIST, one per line')
+    ap.add_argument('-O', dest='opt_level', type=int, choices=[0, 1, 2], default=2,
+                    help='optimisation level: 0 skips the CFG and keeps every temporary on the stack, 1 simplifies the CFG and allocates registers, 2 also threads jumps (default: 2)')
+    ap.add_argument('-j', dest='jobs', type=int, default=1,
+                    help='number of worker processes, 0 for one per core (default: 1)')
+    ap.add_argument('--emit-tac', dest='emit_tac', action='store_true', default=False,
+                    help='write the TAC to <name>.tac.json (and <name>.opt.tac.json)')
+    ap.add_argument('--emit-asm', dest='emit_asm', action='store_true', default=False,
+                    help='also write the assembly to <name>.s (it always goes to <name>.x64-linux.s)')
+    ap.add_argument('--serve', dest='serve', metavar='SOCK', type=str, default=None,
+                    help='run a compile server on the Unix socket SOCK (with -j concurrent compilations)')
+    ap.add_argument('--client', dest='client', metavar='SOCK', type=str, default=None,
+                    help='compile on the server at SOCK, or in this process if it is not running')
+    ap.add_argument('--cache-dir', dest='cache_dir', metavar='DIR', type=str, default=None,
+                    help='reuse the assembly of previous compilations of the same source, or of the same procedures, stored in DIR')
+    ap.add_argument('--cache-size', dest='cache_size', metavar='MB', type=int, default=256,
+                    help='size limit of the --cache-dir cache in MB, least recently used entries are evicted (default: 256)')
+    ap.add_argument('--time-passes', dest='time_passes', action='store_true', default=False,
+                    help='print the time of every stage, and the size of what it produced')
+    ap.add_argument('--pass-memory', dest='pass_memory', action='store_true', default=False,
+                    help='with --time-passes, also compile every file a second time with tracemalloc on to report the peak memory of every stage (the timings come from the first, untraced compilation)')
+    ap.add_argument('--time-passes-json', dest='time_passes_json', metavar='FILE', type=str, default=None,
+                    help='write the --time-passes statistics of every file to FILE as JSON')
+    args = ap.parse_args()
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+
+    if args.serve is not None:
+        bxserver.serve(args.serve, jobs)
+        sys.exit(0)
+    if len(args.files) == 0:
+        ap.error('no input files')
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = CompileCache(args.cache_dir, args.cache_size << 20)
+
+    time_passes = args.time_passes or args.time_passes_json is not None
+    statuses = []
+    all_stats = []
+    for file_path, status, diagnostics, stats in compile_all(args.files, args.opt_level, args.emit_tac, args.emit_asm,
+                                                             jobs, cache, args.client, time_passes,
+                                                             args.pass_memory):
+        if diagnostics is not None:
+            print(diagnostics['message'], file=sys.stderr)
+        if stats is not None:
+            if args.time_passes:
+                print(format_table(stats), file=sys.stderr)
+            all_stats.append(stats)
+        statuses.append(status)
+    if args.time_passes_json is not None:
+        with open(args.time_passes_json, 'w') as f:
+            json.dump(all_stats, f, indent=2)
+    if len(args.files) > 1:
+        for file_path, status in zip(args.files, statuses):
+            print(f'{file_path}: exit status {status}', file=sys.stderr)
+    sys.exit(1 if any(statuses) else 0)
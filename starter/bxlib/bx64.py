@@ -4,6 +4,10 @@ import sys
 import os
 from pathlib import Path
 
+from bxlib.bxisel import select
+from bxlib.bxpeephole import peephole
+from bxlib.bxregalloc import allocate, sequentialize, arg_registers as arg_regs, callee_saved_regs
+
 
 binops = {'add': 'addq',
           'sub': 'subq',
@@ -39,20 +43,32 @@ caller_saved = {'rax', 'rcx', 'rdx', 'rdi', 'rsi', 'r8', 'r9', 'r10', 'r11'}
 arg_registers = ['rdi','rsi','rdx','rcx', 'r8', 'r9']
 
 class Tox64:
-    def __init__(self, reporter):
+    def __init__(self, reporter, optimise=True):
         self.temps = {}
+        self.registers = {}     # temporary -> register of the current procedure (see bxregalloc)
+        # instruction selection, register allocation and peephole optimisation
+        self.isel = optimise
+        self.regalloc = optimise
+        self.peephole = optimise
+        self.peephole_counts = {}   # peephole pattern -> number of rewrites
         self.asm = []
         self.body = []
         self.inUse = set()
         self.reporter = reporter
+        self.stack_slots = {}   # procedure -> number of stack slots of its temporaries
+        self.tables = []        # jump tables of the current procedure
 
     
     def lookup_tmp(self, tmp):
+        if type(tmp) == int:
+            return f'${tmp}'    # immediate folded in by bxisel
         if type(tmp) != str:
             self.reporter.report(f'Temporary {tmp} has an unexpected type ({type(tmp)}). Expected str', -2, self.reporter.stage)
             return
         if tmp[0] == '@':
             return f'{tmp[1:]}(%rip)'
+        if tmp in self.registers:
+            return self.registers[tmp]
         if tmp  not in self.temps.keys():
             self.temps[tmp] = f'{-8 * (len(self.temps.keys()) + 1)}(%rbp)'
         # print(self.temps)
@@ -76,8 +92,22 @@ class Tox64:
         args = instr['args']
         body = instr['body']
         self.proc_tmps = 0
+        if self.isel:
+            body = select(body)
+        if self.regalloc:
+            self.registers = allocate(body, args)
+        # arguments passed on the stack stay there; ToTac pushes them in source
+        # order, so the last one is right above the return address
+        for i, arg in enumerate(args[6:]):
+            self.registers.pop(arg, None)
+            self.temps[arg] = f'{16 + 8 * (len(args) - 7 - i)}(%rbp)'
         self.process_body(name, args, body)
         stack_size = len(self.temps.keys())
+        self.stack_slots[name] = stack_size
+        # callee-saved registers we use are saved in the slots after the temporaries
+        saved = [reg for reg in callee_saved_regs if reg in self.registers.values()]
+        saves = [(reg, f'{-8 * (stack_size + i + 1)}(%rbp)') for i, reg in enumerate(saved)]
+        stack_size += len(saved)
         if stack_size % 2 != 0: stack_size += 1 # 16 byte alignment for x64
         self.asm += [
             f'.text',
@@ -87,23 +117,30 @@ class Tox64:
             f'movq %rsp, %rbp',
             f'subq ${8*(stack_size)}, %rsp'
         ]
+        self.asm += [f'movq {reg}, {slot}' for reg, slot in saves]
 
-        for i in range(min(6, len(args))):
-            self.asm += [f'movq %{arg_registers[i]}, {self.lookup_tmp(args[i])}']
+        # the incoming argument registers may themselves be allocated to other arguments
+        self.asm += sequentialize([(arg_regs[i], self.lookup_tmp(args[i]))
+                                   for i in range(min(6, len(args)))
+                                   if args[i] in self.registers or args[i] in self.temps])
 
-        for i, arg in enumerate(args[6:]):
-            self.temps[arg] = f'{8 * (i + 1)}(%rbp)'
-            
+        self.body.append(f'E_{name}:')
+        if self.peephole:
+            self.body = peephole(self.body, self.peephole_counts)
         self.asm += self.body
         self.body = []
         self.temps = {}
+        self.registers = {}
 
+        self.asm += [f'movq {slot}, {reg}' for reg, slot in saves]
         self.asm += [
-            f'E_{name}:',
             f'movq %rbp, %rsp',
             f'popq %rbp',
             f'retq'
         ]
+        if self.tables:
+            self.asm += [f'.section .rodata', f'.align 4'] + self.tables
+            self.tables = []
 
 
     def process_body(self, proc_name, proc_args, proc_body):
@@ -128,6 +165,10 @@ class Tox64:
                 self.process_label(args)
             elif opcode == 'cmpq':
                 self.process_boolop(args)
+            elif opcode == 'lea':
+                self.process_lea(args, result)
+            elif opcode == 'jtab':
+                self.process_jtab(args)
             elif opcode =='ret':
                 if args != []:
                     self.body += [f'movq {self.lookup_tmp(args[0])}, %rax']
@@ -136,6 +177,11 @@ class Tox64:
                 self.process_call(args, result)
             elif opcode == 'param':
                 self.process_param(args)
+            elif opcode == 'setexc':
+                # the exception status is returned in %rdx, next to %rax
+                self.body += [f'movq {self.lookup_tmp(args[0])}, %rdx']
+            elif opcode == 'getexc':
+                self.body += [f'movq %rdx, {self.lookup_tmp(result)}']
             else:
                 self.reporter.report(f'Processing Intruction: unknown opcode {opcode}', -2, self.reporter.stage)
         
@@ -165,7 +211,17 @@ class Tox64:
         arg2 = self.lookup_tmp(args[1])
         result = self.lookup_tmp(result)
         op = binops[opcode]
-        if type(op) == str:
+        if opcode == 'mul' and arg2[0] == '$':
+            # three operand imulq, its destination must be a register
+            dest = result if result[0] == '%' else '%r11'
+            self.body += [f'imulq {arg2}, {arg1}, {dest}']
+            if dest != result:
+                self.body += [f'movq %r11, {result}']
+        elif opcode == 'add' and result[0] == '%' and arg1[0] == '%' and arg1 != result and arg2[0] in '%$':
+            # leaq adds into a third register
+            address = f'{arg2[1:]}({arg1})' if arg2[0] == '$' else f'({arg1},{arg2})'
+            self.body += [f'leaq {address}, {result}']
+        elif type(op) == str:
             self.body += [f'movq {arg1}, %r11',
                         f'{op} {arg2}, %r11',
                         f'movq %r11, {result}']
@@ -187,14 +243,52 @@ class Tox64:
             self.reporter.report(f'Processing cmpq: expected len(args) == 2, found length {len(args)}', -2, self.reporter.stage)
         arg1 = self.lookup_tmp(args[0])
         arg2 = self.lookup_tmp(args[1])
-        self.body += [f'movq {arg2}, %r11']
-        self.body += [f'cmpq %r11, {arg1}']
+        if arg2 == '$0' and arg1[0] == '%':
+            self.body += [f'testq {arg1}, {arg1}']
+        elif arg2[0] == '$':
+            self.body += [f'cmpq {arg2}, {arg1}']
+        else:
+            self.body += [f'movq {arg2}, %r11']
+            self.body += [f'cmpq %r11, {arg1}']
+
+    def process_lea(self, args, result):
+        base, index, scale = args
+        if type(base) == int:
+            address = f'{base}(,'
+        else:
+            base = self.lookup_tmp(base)
+            if base[0] != '%':
+                self.body += [f'movq {base}, %r11']
+                base = '%r11'
+            address = f'({base},'
+        index = self.lookup_tmp(index)
+        if index[0] != '%':
+            self.body += [f'movq {index}, %rax']
+            index = '%rax'
+        result = self.lookup_tmp(result)
+        dest = result if result[0] == '%' else '%r11'
+        self.body += [f'leaq {address}{index},{scale}), {dest}']
+        if dest != result:
+            self.body += [f'movq %r11, {result}']
 
     def process_jump(self, opcode, args):
         if len(args) != 1:
             self.reporter.report(f'Processing Jump ({opcode}): expected len(args) == 1, found length {len(args)}', -2, self.reporter.stage)
         self.body += [f'{opcode} .L{args[0]}']
 
+    def process_jtab(self, args):
+        # the table holds 32-bit offsets from its own address, which need no relocation
+        default, index, targets = args[0], self.lookup_tmp(args[1]), args[2:]
+        table = f'.L{default}_table'
+        self.body += [f'movq {index}, %r11',
+                      f'cmpq ${len(targets) - 1}, %r11',
+                      f'ja .L{default}',    # unsigned: negative indices are out of range too
+                      f'leaq {table}(%rip), %rax',
+                      f'movslq (%rax,%r11,4), %r11',
+                      f'addq %rax, %r11',
+                      f'jmp *%r11']
+        self.tables += [f'{table}:'] + [f'.long .L{label} - {table}' for label in targets]
+
     def process_label(self, args):
         if len(args) != 1:
             self.reporter.report(f'Processing Label ({args[0]}): expected len(args) == 1, found length {len(args)}', -2, self.reporter.stage)
@@ -208,8 +302,9 @@ class Tox64:
     def process_call(self, args, result):
         name, num_args = args
         self.body += [f'callq {name[1:]}']
-        if num_args > 6:
-            self.body += [f'addq ${8*(num_args-6)}, %rsp']
+        # ToTac passes the number of arguments plus one
+        if num_args - 1 > 6:
+            self.body += [f'addq ${8*(num_args-1-6)}, %rsp']
         if result != None:
             self.body += [f'movq %rax, {self.lookup_tmp(result)}']
 
@@ -221,6 +316,20 @@ class Tox64:
             self.body += [f'pushq {self.lookup_tmp(var)}']
 
 
+    def compile_data(self, tjs):
+        """Compile the TAC program `tjs' (list of gvar/proc dicts) and return the assembly as a string"""
+        assert isinstance(tjs, list), tjs
+        self.tac_to_asm(tjs)
+        return self.render()
+
+    def render(self):
+        """The assembly emitted so far (self.asm) as a string"""
+        asm = ['\t' + line for line in self.asm]
+        asm[:0] = [f'\t.section .rodata',
+                    f'.lprintfmt:',
+                    f'\t.string "%ld\\n"']
+        return '\n'.join(asm) + '\n'
+
     def compile_tac(self, file):
         if file.endswith('.opt.tac.json'):
             rname = file[:-13]
@@ -233,16 +342,11 @@ class Tox64:
         tjs = None
         with open(file, 'rb') as fp:
             tjs = json.load(fp)
-        assert isinstance(tjs, list), tjs
-        self.tac_to_asm(tjs)
-        asm = ['\t' + line for line in self.asm]
-        asm[:0] = [f'\t.section .rodata',
-                    f'.lprintfmt:',
-                    f'\t.string "%ld\\n"']
+        asm = self.compile_data(tjs)
         sname = rname + '.s'
         with open(sname, 'w') as afp:
-            print(*asm, file=afp, sep='\n')
+            afp.write(asm)
         
         sname = rname + '.x64-linux.s'
         with open(sname, 'w') as afp:
-            print(*asm, file=afp, sep='\n')
\ No newline at end of file
+            afp.write(asm)
\ No newline at end of file
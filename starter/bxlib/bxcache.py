@@ -0,0 +1,97 @@
+#! /usr/bin/env python3
+
+#--------- Compilation cache ---------#
+# Content-addressed store of generated assembly. An entry is keyed on the
+# SHA-256 of the compiler version, the options and the source text, and is
+# kept as <dir>/<key[:2]>/<key>.s. The file modification times double as the
+# LRU order: hits touch the entry, and stores evict the least recently used
+# entries once the cache grows past its size limit.
+
+import os
+import glob
+import hashlib
+
+_compiler_version = None
+
+def compiler_version():
+    """Hash of the compiler sources, so that changing the compiler invalidates the cache"""
+    global _compiler_version
+    if _compiler_version is None:
+        h = hashlib.sha256()
+        here = os.path.dirname(os.path.abspath(__file__))
+        for path in sorted(glob.glob(os.path.join(here, '*.py'))):
+            with open(path, 'rb') as f:
+                h.update(f.read())
+        _compiler_version = h.hexdigest()
+    return _compiler_version
+
+
+class CompileCache:
+    def __init__(self, directory, max_bytes=256 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total = None   # estimated size of the cache, the directory is only rescanned to evict
+
+    def key(self, source, opt_level):
+        h = hashlib.sha256()
+        h.update(compiler_version().encode('utf-8'))
+        h.update(f'-O{opt_level}\0'.encode('utf-8'))
+        h.update(source.encode('utf-8'))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.s')
+
+    def get(self, key):
+        """Return the cached assembly for `key', or None on a miss"""
+        path = self.path(key)
+        try:
+            with open(path, 'r') as f:
+                asm = f.read()
+            os.utime(path)      # most recently used
+        except OSError:
+            return
+        return asm
+
+    def put(self, key, asm):
+        path = self.path(key)
+        tmp = f'{path}.{os.getpid()}'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, 'w') as f:
+                f.write(asm)
+            os.replace(tmp, path)   # atomic, concurrent compilers never see a partial entry
+        except OSError:
+            return
+        if self.total is None:
+            self.total = sum(size for _, size, _ in self.entries())
+        else:
+            self.total += len(asm)
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        """List of (mtime, size, path) of every entry"""
+        result = []
+        for path in glob.glob(os.path.join(self.directory, '??', '*.s')):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue    # evicted by another compiler meanwhile
+            result.append((st.st_mtime, st.st_size, path))
+        return result
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes"""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self.total = total
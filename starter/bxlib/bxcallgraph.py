@@ -0,0 +1,64 @@
+#! /usr/bin/env python3
+
+#--------- Call graph analyses ---------#
+# The TypeChecker records, for every procedure, the procedures it calls and
+# whether it contains a raise statement. may_raise propagates the latter
+# backwards over the call graph one strongly connected component at a time,
+# callees first, so that mutually recursive procedures are solved together.
+
+def strongly_connected_components(graph):
+    """Tarjan's algorithm on `graph' (node -> iterable of successors), without
+    recursion. Returns the components in reverse topological order: every
+    component comes after the components it has edges to."""
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+    counter = 0
+    for root in graph:
+        if root in index:
+            continue
+        work = [(root, iter(graph.get(root, ())))]
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, successors = work[-1]
+            for succ in successors:
+                if succ not in index:
+                    index[succ] = lowlink[succ] = counter
+                    counter += 1
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(graph.get(succ, ()))))
+                    break
+                if succ in on_stack:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+def may_raise(calls, raisers):
+    """The set of procedures that may return with an exception set: those in
+    `raisers' and those calling one of them. `calls' maps each procedure to
+    the procedures it calls; callees missing from it (the runtime) only raise
+    if they are in `raisers'."""
+    result = set()
+    for component in strongly_connected_components(calls):
+        if any(p in raisers or any(q in result or q in raisers for q in calls.get(p, ())) for p in component):
+            result.update(component)
+    return result
@@ -9,11 +9,26 @@ compatible_jmps = {
     'jnz': (['jnz','jg','jl'], ['jz']),
 }
 
+inverted = {'jl': 'jge', 'jge': 'jl', 'jg': 'jle', 'jle': 'jg', 'jz': 'jnz', 'jnz': 'jz'}
+
+# the same test with the operands of the comparison swapped
+mirrored = {'jl': 'jg', 'jg': 'jl', 'jle': 'jge', 'jge': 'jle', 'jz': 'jz', 'jnz': 'jnz'}
+
+# Simplification passes run by CFG.optimise at each optimisation level (-O<n>)
+# -O0 does not build a CFG at all
+optimisation_passes = {
+    1: ['useless', 'coalesce', 'unreachable'],
+    2: ['useless', 'coalesce', 'unreachable', 'jump_threadingC', 'coalesce'],
+}
+
 class Block:
     def __init__(self, content, label):
         self.content = content
-        self.next = []
-        self.prev = []
+        # label -> condition of the edge from/to that block, kept in sync by
+        # CFG.add_edge and CFG.remove_edge; dicts rather than sets so that the
+        # order of the successors, hence the layout, is deterministic
+        self.next = {}
+        self.prev = {}
         self.label = label
 
     def __str__(self):
@@ -25,12 +40,13 @@ class Block:
         return s
 
 class CFG:
-    def __init__(self, reporter):
-        self.blocks = {}
-        self.edges = []     # List of DIRECTED LABELED edges. Edge: (Label origin, Label destination, Condition) with Condition: (var1, comparison, var2) | True
+    def __init__(self, reporter, level=2):
+        self.blocks = {}    # Edges are stored in the blocks, with Condition: (var1, comparison, var2) | True
         self.label_counter = 0
         self.reporter = reporter
         self.proc = ""
+        self.passes = optimisation_passes[level]
+        self.block_counts = {}  # procedure -> (blocks before, blocks after) optimise
 
     def run(self, data):
         result = []
@@ -41,41 +57,40 @@ class CFG:
             self.proc = tac['proc'][1:]
             self.bbinference(tac['body'],)
             self.build_graph()
+            before = len(self.blocks)
             self.optimise()
+            self.block_counts[self.proc] = (before, len(self.blocks))
             result += self.serialise(tac['proc'], tac['args'])
             self.blocks = {}
-            self.edges = [] 
             self.proc =''
             self.label_counter = 0
         return result
 
     def new_label(self):
         self.label_counter += 1
-        return f'b{self.label_counter - 1}'
+        return f'{self.proc}_b{self.label_counter - 1}'
+
+    def add_edge(self, origin, destination, condition):
+        # two jumps to the same block with different conditions say nothing about the condition
+        if destination in self.blocks[origin].next and self.blocks[origin].next[destination] != condition:
+            condition = True
+        self.blocks[origin].next[destination] = condition
+        self.blocks[destination].prev[origin] = condition
+
+    def remove_edge(self, origin, destination):
+        del self.blocks[origin].next[destination]
+        del self.blocks[destination].prev[origin]
 
     def optimise(self):
+        # each pass only ever removes blocks or jumps, so this reaches the fixpoint
         optimised = True
-        cycles = 0
         count = 0
-        while optimised and cycles < 10:
+        while optimised:
             optimised = False
-            tmp = self.useless()
-            count += tmp
-            if tmp != 0: optimised = True
-            tmp = self.coalesce()
-            count += tmp
-            if tmp != 0: optimised = True
-            tmp = self.unreachable()
-            count += tmp
-            if tmp != 0: optimised = True
-            count += tmp
-            if tmp != 0: optimised = True
-            tmp = self.jump_threadingC()
-            count += tmp
-            if tmp != 0: optimised = True
-            tmp = self.coalesce()
-            count += tmp
-            cycles += 1
+            for name in self.passes:
+                tmp = getattr(self, name)()
+                count += tmp
+                if tmp != 0: optimised = True
         return count
 
 
@@ -91,12 +106,12 @@ class CFG:
         for i in range(len(tac)):
             if first != '':
                 if tac[i]['opcode'][0] == 'j' and first in tac[i]['args']: 
-                    tac[i]['args'][tac[i]['args'].index(first)] = f'{self.proc}_initial'
-            if tac[i]['opcode'] == 'jmp':
+                    tac[i]['args'] = [f'{self.proc}_initial' if arg == first else arg for arg in tac[i]['args']]
+            if tac[i]['opcode'] in ('jmp', 'jtab'):
                 self.blocks[label].content.append(tac[i])
                 if (i + 1 < len(tac)) and tac[i + 1]['opcode'] != 'label':
                     prev = label
-                    label = f'b{self.label_counter}'
+                    label = f'{self.proc}_b{self.label_counter}'
                     self.blocks[label] = Block([{'opcode': 'label', 'args': [label], 'result': None}], label)
                     self.label_counter += 1
 
@@ -104,7 +119,7 @@ class CFG:
                 self.blocks[label].content.append(tac[i])
                 if (i + 1 < len(tac)) and tac[i + 1]['opcode'] != 'label':
                     prev = label
-                    label = f'b{self.label_counter}'
+                    label = f'{self.proc}_b{self.label_counter}'
                     self.blocks[label] = Block([{'opcode': 'label', 'args': [label], 'result': None}], label)
                     self.label_counter += 1
                     self.blocks[prev].content.append({'opcode': 'jmp', 'args': [label], 'result': None})
@@ -115,226 +130,266 @@ class CFG:
             elif tac[i]['opcode'] == 'label':
                 prev = label
                 label = str(tac[i]['args'][0])
-                if i != 0 and self.blocks[prev].content[-1]['opcode'] not in ['jmp','ret']:
+                if i != 0 and self.blocks[prev].content[-1]['opcode'] not in ['jmp', 'jtab', 'ret']:
                     self.blocks[prev].content.append({'opcode': 'jmp', 'args': [label], 'result': None})
                 self.blocks[label] = Block([tac[i]] , label)
 
             else:
                 self.blocks[label].content.append(tac[i])
-        if self.blocks[label].content[-1]['opcode'] not in ['jmp', 'ret']:
+        if self.blocks[label].content[-1]['opcode'] not in ['jmp', 'jtab', 'ret']:
             self.blocks[label].content.append({'opcode': 'ret', 'args': [], 'result': None})
 
     def build_graph(self):
         for label, block in self.blocks.items():
+            if block.content[-1]['opcode'] == 'jtab':
+                # every entry of a jump table is an unconditional edge
+                args = block.content[-1]['args']
+                for tmp in args[:1] + args[2:]:
+                    self.add_edge(label, str(tmp), True)
+                continue
             i = 1
             while block.content[-i]['opcode'][0] == 'j':
                 condition = get_condition(block, i)
-                tmp = str(block.content[-i]['args'][0])
-                block.next.append(tmp)
-                self.blocks[tmp].prev.append(label)
-                self.edges.append((label, tmp, condition))
+                self.add_edge(label, str(block.content[-i]['args'][0]), condition)
                 i += 1
 
 
     def serialise(self, f_name, f_args):
+        # Lay the blocks out in traces: each block is followed by its most
+        # likely successor that is not placed yet, so that the jump to it can
+        # be dropped. The successors left over start the next traces, most
+        # recent first, which keeps loop bodies and if branches together.
+        depth = self.loop_depths()
+        order = []
+        placed = set()
+        pending = []
+        labels = iter(self.blocks)
         current = f'{self.proc}_initial'
-        result = []
-        labels = [str(l) for l in self.blocks.keys()]
-        schedule = [f'{self.proc}_initial']
-        result += self.blocks[current].content
-        if self.blocks[f'{self.proc}_initial'].content[-1]['opcode'][0] == 'j':
-            next = [str(self.blocks[f'{self.proc}_initial'].content[-1]['args'][0])]
-        while set(schedule) != set(labels):
-            if current in schedule:
+        while current is not None:
+            while current is not None:
+                order.append(current)
+                placed.add(current)
+                successors = [l for l in self.blocks[current].next if l not in placed]
+                if successors == []:
+                    break
+                content = self.blocks[current].content
+                taken = content[-2]['args'][0] if len(content) > 1 and content[-2]['opcode'] in inverted else None
+                # stay in the innermost loop, then prefer blocks only reached from here, then the jcc target
+                current = max(successors, key=lambda l: (depth[l], len(self.blocks[l].prev) == 1, l == taken))
+                pending += [l for l in reversed(successors) if l != current]
+            current = None
+            while pending and current is None:
+                l = pending.pop()
+                if l not in placed:
+                    current = l
+            if current is None:
                 for l in labels:
-                    if l not in schedule:
+                    if l not in placed:
                         current = l
                         break
-            while next != []:
-                
-                if current!=f'{self.proc}_initial':
-                    result += self.blocks[current].content
-                    schedule.append(current)
-                if self.blocks[current].content[-1]['opcode'][0] == 'j':
-                    l   = str(self.blocks[current].content[-1]['args'][0])
-                if l not in schedule:
-                    current = l
-                else:
-                    for l in self.blocks[current].next:
-                        if l not in schedule:
-                            current = l
-                            break
-                    break
+
+        result = []
+        for i, label in enumerate(order):
+            content = self.blocks[label].content
+            following = order[i + 1] if i + 1 < len(order) else None
+            if content[-1]['opcode'] == 'jmp' and len(content) > 1 and content[-2]['opcode'] in inverted:
+                if content[-2]['args'][0] == following:
+                    # cmpq; jCC next; jmp B  ->  cmpq; jNCC B
+                    content[-2:] = [{'opcode': inverted[content[-2]['opcode']], 'args': content[-1]['args'], 'result': None}]
+            if content[-1]['opcode'] == 'jmp' and content[-1]['args'][0] == following:
+                content.pop()
+                # a conditional jump to the next block is useless as well, and so is its cmpq
+                if content[-1]['opcode'] in inverted and content[-1]['args'][0] == following:
+                    content.pop()
+                    if content[-1]['opcode'] == 'cmpq':
+                        content.pop()
+            result += content
         return [{"proc": f_name, "args": f_args, "body": result}]
-    
+
+    def loop_depths(self):
+        # Number of loops each block is in. The loops are found from the back
+        # edges of a depth-first search, which are the loops of the CFG of a
+        # structured BX procedure; a loop is its header and every block that
+        # reaches a back edge to it without going through it.
+        depth = dict.fromkeys(self.blocks, 0)
+        start = f'{self.proc}_initial'
+        visited = {start}
+        on_stack = {start}
+        work = [(start, iter(self.blocks[start].next))]
+        bodies = {}     # loop header -> blocks of the loop
+        while work:
+            node, successors = work[-1]
+            for l in successors:
+                if l in on_stack:
+                    body = bodies.setdefault(l, {l})
+                    stack = [node]
+                    while stack:
+                        n = stack.pop()
+                        if n not in body:
+                            body.add(n)
+                            stack.extend(self.blocks[n].prev)
+                elif l not in visited:
+                    visited.add(l)
+                    on_stack.add(l)
+                    work.append((l, iter(self.blocks[l].next)))
+                    break
+            else:
+                work.pop()
+                on_stack.remove(node)
+        for body in bodies.values():
+            for l in body:
+                depth[l] += 1
+        return depth
+
 # ----------------  Optimisation Functions  ------------------
 
 
     def coalesce(self):
-        # self.print_blocks()
+        # Merging l2 into l1 only changes the successors of l1, so each block
+        # is visited once and absorbs the whole chain of blocks after it
         count = 0
-        found = True
-        while found:
-            found = False
-            for l1, b1 in self.blocks.items():
-                if len(b1.next) != 1:
-                    continue
-                l2 = b1.next[0]
+        for l1 in list(self.blocks):
+            b1 = self.blocks.get(l1)
+            while b1 is not None and len(b1.next) == 1:
+                l2 = next(iter(b1.next))
                 b2 = self.blocks[l2]
-                if len(b2.prev) != 1 or l2 == f'{self.proc}_initial':
-                    continue
-                # print(f'Attempting to coalesce blocks {l1} and {l2}')
+                if len(b2.prev) != 1 or l2 == f'{self.proc}_initial' or l2 == l1:
+                    break
                 self.aux_coalesce(l1,b1,l2,b2)
-                found = True
                 count += 1
-                break
         return count
                 
     def aux_coalesce(self,l1,b1,l2,b2):
-        #Change next
-        for l in b2.next:
-            try:
-                self.blocks[l].prev.remove(l2)
-            except:
-                # print(f'Issue when coalescing blocks {l1} and {l2}.')
-                self.reporter.report(f'Trying to remove node {l2} from list ({self.blocks[l].prev}) of previous blocks of {l}', -1,  'Optimisation: coalescing')
-            self.blocks[l].prev.append(l1)
-        
-            # Change label
-            to_remove = [edge for edge in self.edges if edge[0] == l2 and edge[1] == l]
-            for edge in to_remove:
-                self.edges.append((l1, l, edge[2]))
-                self.edges.remove(edge)
-
-
-        b1.next = b2.next
-
-        # Change content
-        b1.content = b1.content[:-1] + b2.content
+        self.remove_edge(l1, l2)
+        for l, condition in list(b2.next.items()):
+            self.remove_edge(l2, l)
+            self.add_edge(l1, l, condition)
+
+        # Change content: drop the jumps to l2
+        while b1.content[-1]['opcode'][0] == 'j':
+            b1.content.pop()
+        b1.content += b2.content
         del self.blocks[l2]
 
     def unreachable(self):
         count = 0
-        not_visited = set([str(b) for b in self.blocks.keys()])
+        visited = {f'{self.proc}_initial'}
         stack = [f'{self.proc}_initial']
 
         while stack != []:
             node = stack.pop()
-            not_visited.remove(node)
-            stack.extend(str(n) for n in self.blocks[node].next if (str(n) in not_visited and str(n) not in stack))
-        
+            for n in self.blocks[node].next:
+                if n not in visited:
+                    visited.add(n)
+                    stack.append(n)
+
+        not_visited = [l for l in self.blocks if l not in visited]
+        for l in not_visited:
+            # Modify Edges, the edges between unreachable blocks are removed from both ends
+            for n in list(self.blocks[l].next):
+                self.remove_edge(l, n)
+            for p in list(self.blocks[l].prev):
+                self.remove_edge(p, l)
         for l in not_visited:
             count += 1
             del self.blocks[l]
 
-            # Modify Edges
-            removable_edges = []
-            for edge in self.edges:
-                if edge[0] == l or edge[1] == l:
-                    removable_edges.append(edge)
-            for edge in removable_edges:
-                self.edges.remove(edge)
-
         return count
 
     def useless(self):  # Remove Blocks consisting of only a label and an unconditional jump
-        found = True
+        # Redirecting the jumps to a block does not change the length of any
+        # block, so one visit of each block finds them all
         count = 0
-        while found:
-            found = False
-            for label, block in self.blocks.items():
-                if len(block.content) == 2 and block.next != [] and label != f'{self.proc}_initial':
-                    n = self.blocks[label].next[0]
-                    for prev in self.blocks[label].prev:
-                        self.replace_label(self.blocks[prev], label, n)
-
-                        # Modify Edges
-                        tmp = tuple()
-                        for edge in self.edges:
-                            if edge[0] == prev and edge[1] == label:
-                                tmp = edge
-                                break
-                        self.edges.remove(tmp)
-                        self.edges.append((tmp[0],n,tmp[2]))
-
-                    self.blocks[n].prev.remove(label)
-                    self.blocks[n].prev.extend(block.prev)
-
-                    found = True
-                    count += 1
-                    del self.blocks[label]
-                    break
+        for label in list(self.blocks):
+            block = self.blocks[label]
+            if (len(block.content) == 2 and block.content[-1]['opcode'] == 'jmp'
+                    and label != f'{self.proc}_initial'):
+                n = next(iter(block.next))
+                if n == label:
+                    continue
+                for prev, condition in list(block.prev.items()):
+                    self.replace_label(self.blocks[prev], label, n)
+                    # Modify Edges
+                    self.remove_edge(prev, label)
+                    self.add_edge(prev, n, condition)
+                self.remove_edge(label, n)
+
+                count += 1
+                del self.blocks[label]
         return count
 
     def replace_label(self, block, old_l, new_l):
         for instruction in block.content:
-            if instruction['opcode'][0] == 'j' and str(instruction['args'][0]) == old_l:
+            if instruction['opcode'] == 'jtab':
+                # the second argument is the index, the others are labels
+                instruction['args'] = [new_l if k != 1 and str(l) == old_l else l
+                                       for k, l in enumerate(instruction['args'])]
+            elif instruction['opcode'][0] == 'j' and str(instruction['args'][0]) == old_l:
                 instruction['args'][0] = new_l
-        block.next = [l if old_l != l else new_l for l in block.next]
 
     def thread(self, l1, l2):
-        for edge in self.edges:
-            if edge[0] == l1 and edge[1] == l2:
-                c1 = edge[2]
-            if edge[0] == l2 and edge[2]!=True:
-                c2 = edge[2]
-                l3 = edge[1]
-
-        if (c1[0]==c2[0] and c1[2]==c2[2]) or ( c1[0]==c2[2] and c1[2]==c2[0] ):
-                
-            if c2[1] in compatible_jmps[c1[1]][0]:      # Condition always true (always take conditional jump)
-                l4 = self.blocks[l2].content[-1]['args'][0]
-                del self.blocks[l2].content[-2]
-                self.blocks[l2].content[-1]['args']=l3
-                self.blocks[l2].next = [l3]
-                self.blocks[l4].prev.remove(l2)
+        # Returns the block that lost l2 as predecessor, or None if nothing changed
+        c1 = self.blocks[l1].next[l2]
+        conditional = [(l, c) for l, c in self.blocks[l2].next.items() if c != True]
+        if not conditional:
+            return
+        l3, c2 = conditional[0]
+
+        if c1[0]==c2[0] and c1[2]==c2[2]:
+            jmp2 = c2[1]
+        elif c1[0]==c2[2] and c1[2]==c2[0]:
+            # compare the operands in the order of c1
+            jmp2 = mirrored.get(c2[1])
+        else:
+            return
 
-                # modify edges
-                self.edges.remove((l2,l4,True))
-                self.edges.remove((l2,l3,c2))
-                self.edges.append((l2,l3,True))
-                return True
+        if jmp2 is None:
+            return
 
+        if jmp2 in compatible_jmps[c1[1]][0]:      # Condition always true (always take conditional jump)
+            l4 = self.blocks[l2].content[-1]['args'][0]
+            del self.blocks[l2].content[-2]
+            self.blocks[l2].content[-1]['args'] = [l3]
 
-            if c2[1] in compatible_jmps[c1[1]][1]:  # Condition never true (never take conditional jump)
-                l4 = self.blocks[l2].content[-1]['args'][0]
-                # print(l1,l2,l3,l4)
+            # modify edges
+            self.remove_edge(l2, l4)
+            self.remove_edge(l2, l3)
+            self.add_edge(l2, l3, True)
+            return l4
 
-                del self.blocks[l2].content[-2]
-                self.blocks[l2].next = [l4]
-                self.blocks[l3].prev.remove(l2)
 
-                # modify edges
-                self.edges.remove((l2,l3,c2))
-                return True
+        if jmp2 in compatible_jmps[c1[1]][1]:  # Condition never true (never take conditional jump)
+            del self.blocks[l2].content[-2]
+
+            # modify edges
+            self.remove_edge(l2, l3)
+            return l3
 
     def jump_threadingC(self):
-        found = True
+        # Threading l2 removes one of its edges: the block at the other end may
+        # then have a single predecessor, and is the only one to visit again
         count = 0
-        while found:
-            found = False
-            possible = self.find_possible_threading()
-            if not possible:
+        worklist = list(self.blocks)
+        while worklist:
+            l2 = worklist.pop()
+            l1 = self.find_possible_threading(l2)
+            if l1 is None:
                 continue
-            if self.thread(possible[0], possible[1]):
+            changed = self.thread(l1, l2)
+            if changed:
                 count += 1
-                found = True
+                worklist.append(changed)
         return count
 
-    def find_possible_threading(self):
-        # Identify potential blocks for threading
-        for l1, b1 in self.blocks.items():
-            for edge in self.edges:
-                if edge[0] != l1 or edge[2]==True: continue
-
-                l2 = edge[1]
-                b2 = self.blocks[l2]
+    def find_possible_threading(self, l2):
+        # The only predecessor of l2, if it jumps to l2 on a condition that l2 tests again
+        b2 = self.blocks[l2]
+        if len(b2.prev) != 1 or len(b2.next)!=2 or b2.content[-1]['opcode'] == 'jtab': return
+        l1, condition = next(iter(b2.prev.items()))
+        if condition==True: return
 
-                if len(b2.prev) != 1 or len(b2.next)!=2: continue
-                
-                if check_no_change(b2,edge[2][0]) and check_no_change(b2, edge[2][2]):
-                    return (l1, l2)
-        return
+        if check_no_change(b2,condition[0]) and check_no_change(b2, condition[2]):
+            return l1
 
 # ----------------  Debugging Functions  ------------------
 
@@ -352,21 +407,17 @@ class CFG:
         return called == defined
     
     def check_edges(self):
-        for edge in self.edges:
-            if edge[1] not in self.blocks[edge[0]].next or edge[0] not in self.blocks[edge[1]].prev:
-                print("NOT GOOD:", edge)
-                return False
-
         for label, block in self.blocks.items():
-            for n in block.next:
-                found = False
-                for edge in self.edges:
-                    if edge[0]==label and edge[1]==n:
-                        found = True
-                if not found:
+            for n, condition in block.next.items():
+                if n not in self.blocks or self.blocks[n].prev.get(label) != condition:
                     print("NOT GOOD:", label, n)
                     return False
+            for p in block.prev:
+                if p not in self.blocks or label not in self.blocks[p].next:
+                    print("NOT GOOD:", p, label)
+                    return False
         print("ALL EDGES GOOD")
+        return True
 
 
 # ----------------  Helper Functions  ------------------
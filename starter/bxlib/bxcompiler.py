@@ -0,0 +1,227 @@
+#! /usr/bin/env python3
+
+import copy
+import contextlib
+import dataclasses as dc
+
+from bxlib.bxast import *
+from bxlib.bxparser import Parser
+from bxlib.bxlexer import Lexer
+from bxlib.bxtac import ToTac
+from bxlib.bxtypechecker import TypeChecker
+from bxlib.bx64 import Tox64
+from bxlib.bxcfg import CFG
+from bxlib.bxstats import count_nodes
+
+
+class CountingLexer:
+    """Wraps a ply lexer to count the tokens it hands to the parser"""
+    def __init__(self, lexer, stats):
+        self.lexer = lexer
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self.lexer, name)
+
+    def token(self):
+        token = self.lexer.token()
+        if token is not None:
+            self.stats.tokens += 1
+        return token
+
+
+class Compiler:
+    """Compiles BX programs one after the other, building the Lexer and Parser
+    (and their tables) only once. Each program is compiled against its own
+    Reporter so errors in one do not leak into the next."""
+
+    def __init__(self, opt_level=2, debug=False):
+        self.opt_level = opt_level
+        self.debug = debug
+        self.lexer = Lexer(None)
+        self.parser = Parser(None)
+        # procedures of the last compile() taken from / added to proc_cache
+        self.procs_reused = 0
+        self.procs_compiled = 0
+        self.stats = None   # PassStats of the current compile(), if any
+
+    def stage(self, reporter, name):
+        """Enter stage `name': set reporter.stage and, with --time-passes, time it"""
+        reporter.stage = name
+        if self.stats is None:
+            return contextlib.nullcontext()
+        return self.stats.stage(name)
+
+    def compile(self, reporter, content, tac_out=None, proc_cache=None, stats=None):
+        """Compile the BX program `content' and return the x64 assembly as a string.
+        Returns None if any stage reported errors (they are left in `reporter').
+        If `tac_out' is a dict, the TAC is stored under 'tac' and, when the CFG
+        runs, the optimised TAC under 'opt_tac'. Otherwise, if `proc_cache' (a
+        bxcache.CompileCache) is given, the assembly of every procedure is
+        looked up there and only the procedures that changed are compiled.
+        If `stats' is a bxstats.PassStats, the time, memory and sizes of every
+        stage are recorded in it."""
+        debug = self.debug
+        self.stats = stats
+        self.lexer.reporter = reporter
+        self.parser.reporter = reporter
+        self.lexer.lexer.lineno = 1
+
+        with self.stage(reporter, 'Parsing'):
+            lexer = self.lexer.lexer if stats is None else CountingLexer(self.lexer.lexer, stats)
+            ast = self.parser.parser.parse(content, lexer=lexer)
+        if reporter.error_number != 0:
+            return
+        if ast is None:
+            if debug: print("Error: Parsing returned None.")
+            return
+        if debug: print('Parsing successfull')
+        if stats is not None:
+            stats.ast_nodes = count_nodes(ast)
+
+        with self.stage(reporter, 'Type Check'):
+            type_checker = TypeChecker(reporter=reporter)
+            type_checker.for_program(ast)
+        if reporter.error_number != 0:
+            return
+        if debug: print('Type Check successfull')
+        if debug:
+            print(ast)
+
+        if proc_cache is not None and tac_out is None:
+            return self.compile_incremental(reporter, ast, type_checker, proc_cache)
+
+        with self.stage(reporter, "Transforming AST to TAC"):
+            totac = ToTac(type_checker.functions, reporter, type_checker.may_raise, type_checker.exception_ids)
+            totac.processProgram(ast)
+        if reporter.error_number != 0:
+            return
+        data = totac.getData()
+        if tac_out is not None:
+            # the CFG rewrites the procedure bodies in place
+            tac_out['tac'] = copy.deepcopy(data)
+        self.count_tac(data)
+
+        if self.opt_level > 0:
+            with self.stage(reporter, "CFG"):
+                cfg = CFG(reporter, self.opt_level)
+                data = cfg.run(data)
+            if tac_out is not None:
+                tac_out['opt_tac'] = data
+            if stats is not None:
+                stats.cfg_blocks.update(cfg.block_counts)
+
+        with self.stage(reporter, "TAC to x64"):
+            tox64 = Tox64(reporter, self.opt_level > 0)
+            asm = tox64.compile_data(data)
+        if reporter.error_number != 0:
+            return
+        if stats is not None:
+            stats.stack_slots.update(tox64.stack_slots)
+            stats.peephole.update(tox64.peephole_counts)
+        return asm
+
+    def compile_incremental(self, reporter, ast, type_checker, proc_cache):
+        """Lower and emit the type checked `ast' one declaration at a time,
+        splicing in the cached assembly of unchanged procedures"""
+        self.procs_reused = 0
+        self.procs_compiled = 0
+        global_types = {var.name: decl.ty.ty for decl in ast if type(decl) == VarDecl for var in decl.var_l}
+        totac = ToTac(type_checker.functions, reporter, type_checker.may_raise, type_checker.exception_ids)
+        tox64 = Tox64(reporter, self.opt_level > 0)
+        cfg = CFG(reporter, self.opt_level) if self.opt_level > 0 else None
+        totac.processPrologue()
+        tox64.tac_to_asm(totac.tac)
+        for decl in ast:
+            key = None
+            if type(decl) == ProcDecl:
+                fingerprint = procedure_fingerprint(decl, type_checker.procedures, global_types,
+                                                    type_checker.may_raise, type_checker.exception_ids)
+                key = proc_cache.key(fingerprint, self.opt_level)
+                asm = proc_cache.get(key)
+                if asm is not None:
+                    tox64.asm += asm.split('\n')
+                    self.procs_reused += 1
+                    continue
+            first = len(totac.tac)
+            with self.stage(reporter, "Transforming AST to TAC"):
+                totac.processDeclaration(decl)
+            if reporter.error_number != 0:
+                return
+            data = totac.tac[first:]
+            self.count_tac(data)
+            if cfg is not None and key is not None:
+                with self.stage(reporter, "CFG"):
+                    data = cfg.run(data)
+            first = len(tox64.asm)
+            with self.stage(reporter, "TAC to x64"):
+                tox64.tac_to_asm(data)
+            if reporter.error_number != 0:
+                return
+            if key is not None:
+                proc_cache.put(key, '\n'.join(tox64.asm[first:]))
+                self.procs_compiled += 1
+        if self.stats is not None:
+            if cfg is not None:
+                self.stats.cfg_blocks.update(cfg.block_counts)
+            self.stats.stack_slots.update(tox64.stack_slots)
+            self.stats.peephole.update(tox64.peephole_counts)
+        return tox64.render()
+
+    def count_tac(self, data):
+        if self.stats is None:
+            return
+        for tac in data:
+            if 'proc' in tac:
+                self.stats.tac_instructions[tac['proc'][1:]] = len(tac['body'])
+
+
+# names of the fields of each AST class that matter for code generation
+ast_fields = {}
+
+def ast_fingerprint(node, parts, names):
+    """Append to `parts' a description of `node' that ignores line numbers, so
+    that moving a procedure around in the file does not change it, and collect
+    the variable, procedure and exception names it mentions in `names'"""
+    cls = type(node)
+    if cls == list:
+        parts.append('[')
+        for item in node:
+            ast_fingerprint(item, parts, names)
+            parts.append(',')
+        parts.append(']')
+    elif isinstance(node, AST):
+        fields = ast_fields.get(cls)
+        if fields is None:
+            fields = ast_fields[cls] = [f.name for f in dc.fields(node) if f.name != 'line']
+        if cls in (VarExpr, Assign, ProcCall, Raise, Catch):
+            names.add(node.name)
+        parts.append(cls.__name__ + '(')
+        for field in fields:
+            parts.append(field + '=')
+            ast_fingerprint(getattr(node, field), parts, names)
+        parts.append(')')
+    else:
+        parts.append(repr(node) + ',')
+
+def procedure_fingerprint(decl, procedures, global_types, may_raise=(), exception_ids={}):
+    """Everything the assembly of the procedure `decl' depends on: its own
+    type checked AST, the signatures of the procedures it calls (and whether
+    they may raise), the types of the globals it uses and the ids of the
+    exceptions it raises or catches"""
+    parts = ['proc ']
+    names = set()
+    ast_fingerprint(decl, parts, names)
+    for name in sorted(names):
+        if name in procedures:
+            parts.append(f'\ncalls {name}: {procedures[name]} may raise: {name in may_raise}')
+        if name in global_types:
+            parts.append(f'\nglobal {name}: {global_types[name]}')
+        if name in exception_ids:
+            parts.append(f'\nexception {name}: {exception_ids[name]}')
+    return ''.join(parts)
+
+
+def compile_source(reporter, content, opt_level=2, debug=False, tac_out=None):
+    """Compile a single BX program, see Compiler.compile"""
+    return Compiler(opt_level, debug).compile(reporter, content, tac_out)
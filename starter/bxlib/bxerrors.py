@@ -7,13 +7,14 @@ class Reporter:
         self.error_number = 0
         self.errors = []
         self.filename = 'Unknown'
+        self.source = None      # source text, when it does not come from self.filename
         self.stage = None
 
     def report(self, reason, line, file):
         self.errors.append([reason, int(line), file])
         self.error_number += 1
     
-    def describe(self):
+    def summary(self):
         msg = ''
         if len(self.errors) != 0:
             msg += "---------------------------------------------\n"
@@ -25,13 +26,22 @@ class Reporter:
                 else:
                     msg += f'Error: {error[0]} on line: {error[1]} during {error[2]}\n'
                 if error[1] > -1:
-                    with open(self.filename, 'r') as file:
-                        for i, line in enumerate(file, 1):  # Start counting from 1
-                            if i == error[1]:
-                                msg += f'\t {line.strip()}\n'
+                    for i, line in enumerate(self.source_lines(), 1):  # Start counting from 1
+                        if i == error[1]:
+                            msg += f'\t {line.strip()}\n'
 
             msg += "---------------------------------------------\n"
             msg += f'TOTAL ERRORS: {self.error_number}\n'
             msg += '----------------------------------------------\n'
-            sys.exit(msg)
+        return msg
+
+    def source_lines(self):
+        if self.source is not None:
+            return self.source.split('\n')
+        with open(self.filename, 'r') as file:
+            return file.readlines()
+
+    def describe(self):
+        if len(self.errors) != 0:
+            sys.exit(self.summary())
         
\ No newline at end of file
@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+
+#--------- Instruction selection ---------#
+# Rebuilds, inside each basic block of a TAC procedure, the expression trees
+# that ToTac flattened into temporaries, and covers them with bigger tiles
+# before Tox64 emits them:
+#
+#   const k -> %t; OP .., %t        OP .., $k     (immediate operand)
+#   mul %y, $s -> %t; add %x, %t    lea %x, %y, s (leaq (x,y,s), s in 1/2/4/8)
+#   cmpq $k, %x; jl L               cmpq %x, $k; jg L (constants compared second)
+#
+# A temporary is only folded into its user when it is defined once in the
+# whole procedure, in the same block as the user, and its definition is only
+# removed once every use has been folded, so that no other instruction sees a
+# different value. Lea trees must moreover be used only once. Immediates are
+# TAC arguments of type int; Tox64.lookup_tmp turns them into `$k'. Which
+# x64 instruction a tile becomes (addq/leaq, cmpq/testq, one or three operand
+# imulq) is chosen by Tox64 once the operands have their locations.
+
+from bxlib.bxregalloc import is_temp, uses_defs
+
+commutative = {'add', 'mul', 'and', 'or', 'xor'}
+# operand positions that may be immediates, per opcode
+immediate_args = {'add': (0, 1), 'mul': (0, 1), 'and': (0, 1), 'or': (0, 1), 'xor': (0, 1),
+                  'sub': (0, 1), 'shl': (0, 1), 'shr': (0, 1), 'div': (0,), 'mod': (0,),
+                  'cmpq': (1,), 'copy': (0,), 'ret': (0,), 'param': (1,),
+                  'setexc': (0,)}
+scales = {1, 2, 4, 8}
+block_end = {'jmp', 'jtab', 'ret', 'jl', 'jg', 'jle', 'jge', 'jz', 'jnz'}
+# condition of a jump after swapping the operands of the cmpq before it
+mirrored = {'jl': 'jg', 'jg': 'jl', 'jle': 'jge', 'jge': 'jle', 'jz': 'jz', 'jnz': 'jnz'}
+
+
+def fits_imm32(value):
+    return type(value) == int and -2**31 <= value < 2**31
+
+def basic_blocks(body):
+    """Split `body' into lists of consecutive instructions, a new block
+    starting at each label and after each jump or ret"""
+    blocks = [[]]
+    for instr in body:
+        if instr['opcode'] == 'label' and blocks[-1]:
+            blocks.append([])
+        blocks[-1].append(instr)
+        if instr['opcode'] in block_end:
+            blocks.append([])
+    return [block for block in blocks if block]
+
+def select(body):
+    """Return a copy of the TAC procedure body `body' with the tiles above"""
+    uses = {}
+    defs = {}
+    for instr in body:
+        u, d = uses_defs(instr)
+        for t in u:
+            uses[t] = uses.get(t, 0) + 1
+        for t in d:
+            defs[t] = defs.get(t, 0) + 1
+    def single(t):
+        return is_temp(t) and uses.get(t) == 1 and defs.get(t) == 1
+    # the conditional jumps after a cmpq read its flags, even in the next blocks up
+    # to a label; swapping is only safe if no block starts by reading flags it did not set
+    may_swap = not any(instr['opcode'] == 'label' and next_instr['opcode'] in mirrored
+                       for instr, next_instr in zip(body, body[1:]))
+    swapped = False     # the operands of the cmpq setting the flags were swapped
+
+    result = []
+    for block in basic_blocks(body):
+        start = len(result)
+        defined = {}    # temporary -> position in result of its definition in this block
+        last_def = {}   # temporary -> position in result of its last definition in this block
+        folded = {}     # constant temporary -> number of uses replaced by an immediate
+        removed = set()
+        for instr in block:
+            instr = {'opcode': instr['opcode'], 'args': list(instr['args']), 'result': instr['result']}
+            opcode, args = instr['opcode'], instr['args']
+
+            def const_of(i):
+                """The immediate args[i] could be replaced with, or None"""
+                t = args[i] if i < len(args) else None
+                if is_temp(t) and defs.get(t) == 1 and t in defined:
+                    tree = result[defined[t]]
+                    if tree['opcode'] == 'const' and fits_imm32(tree['args'][0]):
+                        return tree['args'][0]
+
+            def fold(i):
+                value = const_of(i)
+                if value is None:
+                    return False
+                t = args[i]
+                folded[t] = folded.get(t, 0) + 1
+                if folded[t] == uses[t]:
+                    removed.add(defined[t])
+                args[i] = value
+                return True
+
+            if opcode not in mirrored and opcode != 'jmp':
+                swapped = False
+            if opcode == 'cmpq':
+                swapped = may_swap and const_of(1) is None and const_of(0) is not None
+                if swapped:
+                    args.reverse()
+                fold(1)
+            elif opcode in mirrored:
+                if swapped:
+                    instr['opcode'] = mirrored[opcode]
+            elif opcode in commutative:
+                # one immediate at most, as the second operand
+                if not fold(1) and fold(0):
+                    args.reverse()
+            elif opcode in ('sub', 'shl', 'shr'):
+                fold(1) or fold(0)
+            else:
+                for i in immediate_args.get(opcode, ()):
+                    fold(i)
+
+            if opcode == 'add':
+                for i in (1, 0):
+                    t = args[i]
+                    if not (single(t) and t in defined):
+                        continue
+                    tree = result[defined[t]]
+                    index, scale = tree['args'] if tree['opcode'] == 'mul' else (None, None)
+                    # the index must still hold the value the mul read
+                    if scale in scales and is_temp(index) and last_def.get(index, -1) < defined[t]:
+                        removed.add(defined[t])
+                        instr = {'opcode': 'lea', 'args': [args[1 - i], index, scale], 'result': instr['result']}
+                        break
+
+            result.append(instr)
+            for t in uses_defs(instr)[1]:
+                defined[t] = len(result) - 1
+                last_def[t] = len(result) - 1
+        if removed:
+            result[start:] = [instr for i, instr in enumerate(result[start:], start) if i not in removed]
+    return result
@@ -1,9 +1,88 @@
 #! /usr/bin/env python3
 
+import os
+import json
+import hashlib
+import ply
 import ply.yacc as yacc
 from bxlib.bxlexer import Lexer
 from bxlib.bxast import *
 
+# LALR tables of the Parser below, reused across runs while the grammar is unchanged.
+# The file is plain JSON, so loading a tampered one cannot run code
+PARSETAB_CACHE = os.path.join(os.path.dirname(__file__), '__pycache__', 'bxparsetab.json')
+
+
+#--------- Parse table cache ---------#
+class CachedProduction:
+    """The parts of a ply Production that LRParser needs at parse time"""
+    def __init__(self, name, len, func, str):
+        self.name = name
+        self.len = len
+        self.func = func
+        self.str = str
+        self.callable = None
+
+    def __str__(self):
+        return self.str
+
+class CachedTable:
+    """Stand-in for a ply LRTable whose action/goto tables were loaded from the cache"""
+    def __init__(self, productions, action, goto):
+        self.lr_productions = productions
+        self.lr_action = action
+        self.lr_goto = goto
+
+def grammar_signature(cls):
+    """Hash of everything the LALR tables depend on: tokens, precedence and rule docstrings"""
+    h = hashlib.sha256()
+    h.update(ply.__version__.encode('utf-8'))
+    h.update(repr(cls.tokens).encode('utf-8'))
+    h.update(repr(cls.precedence).encode('utf-8'))
+    for name in sorted(dir(cls)):
+        if name.startswith('p_') and name != 'p_error':
+            h.update(name.encode('utf-8'))
+            h.update((getattr(cls, name).__doc__ or '').encode('utf-8'))
+    return h.hexdigest()
+
+def json_table(rows):
+    """A ply action or goto table from its JSON form, whose keys are strings
+    (ply marks the errors of nonassoc operators with None)"""
+    return {int(state): {symbol: None if value is None else int(value) for symbol, value in row.items()}
+            for state, row in rows.items()}
+
+def load_tables(signature, path=PARSETAB_CACHE):
+    """The tables stored at `path' for the grammar `signature', or None when
+    they are missing, stale or malformed and must be rebuilt"""
+    try:
+        with open(path, 'r', encoding='utf-8') as fp:
+            cached = json.load(fp)
+        if cached['signature'] != signature:
+            return
+        productions = []
+        for name, length, func, text in cached['productions']:
+            # only the p_ rules of the Parser may be called back
+            if func is not None and not (type(func) == str and func.startswith('p_')):
+                return
+            productions.append(CachedProduction(str(name), int(length), func, str(text)))
+        return CachedTable(productions, json_table(cached['action']), json_table(cached['goto']))
+    except (OSError, ValueError, TypeError, KeyError, AttributeError):
+        return  # unreadable, truncated or not the layout written by save_tables
+
+def save_tables(signature, parser, path=PARSETAB_CACHE):
+    cached = {'signature': signature,
+              'productions': [(p.name, p.len, p.func, p.str) for p in parser.productions],
+              'action': parser.action,
+              'goto': parser.goto}
+    tmp = f'{path}.{os.getpid()}'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump(cached, fp, separators=(',', ':'))
+        os.replace(tmp, path)   # atomic, concurrent compilers never see a partial file
+    except OSError:
+        pass    # read-only install: keep building the tables on every run
+
 
 #--------- Parser ---------#
 class Parser:
@@ -274,4 +353,17 @@ class Parser:
         # dictionary of names
         self.names = { }
         self.reporter = reporter
-        self.parser = yacc.yacc(module=self)
+        signature = grammar_signature(type(self))
+        table = load_tables(signature)
+        if table is not None:
+            for p in table.lr_productions:
+                if p.func:
+                    p.callable = getattr(self, p.func, None)
+                    if p.callable is None:
+                        table = None    # not a rule of this grammar
+                        break
+        if table is None:
+            self.parser = yacc.yacc(module=self)
+            save_tables(signature, self.parser)
+        else:
+            self.parser = yacc.LRParser(table, self.p_error)
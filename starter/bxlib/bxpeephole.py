@@ -0,0 +1,153 @@
+#! /usr/bin/env python3
+
+#--------- Peephole optimisation ---------#
+# Rewrites of short windows of the assembly of a procedure body produced by
+# Tox64, before it is added to Tox64.asm. Each entry of `patterns' is
+# (name, function): the function gets the list of instructions and a position
+# and returns None when it does not apply there, or (n, replacement) to
+# replace the n instructions at that position. Tox64 only ever leaves values
+# in the scratch register %r11 for the next instruction or two, so a pattern
+# may drop a write to %r11 once scratch_dead says nobody reads it.
+
+import functools
+
+@functools.lru_cache(maxsize=4096)
+def parse(line):
+    """Split `movq a, b' into ('movq', ('a', 'b')); labels have no operands"""
+    op, _, rest = line.partition(' ')
+    return op, tuple(arg.strip() for arg in rest.split(',')) if rest else ()
+
+inverted = {'jl': 'jge', 'jge': 'jl', 'jg': 'jle', 'jle': 'jg', 'jz': 'jnz', 'jnz': 'jz'}
+
+def is_register(arg):
+    return arg.startswith('%')
+
+def is_memory(arg):
+    return arg.endswith(')')
+
+def is_wide_immediate(arg):
+    """An immediate that does not fit in the 32 bits most instructions take"""
+    return arg.startswith('$') and not -2**31 <= int(arg[1:]) < 2**31
+
+def scratch_dead(lines, i):
+    """Whether %r11 is not read from position i on"""
+    for line in lines[i:]:
+        op, args = parse(line)
+        if op.endswith(':') or op[0] == 'j' or op in ('callq', 'retq'):
+            return True     # %r11 never carries a value across a jump, label or call
+        if any('%r11' in arg for arg in args):
+            # overwritten without being read first
+            return op == 'movq' and args[1] == '%r11' and '%r11' not in args[0]
+    return True
+
+def self_move(lines, i):
+    """movq X, X  ->  (nothing)"""
+    op, args = parse(lines[i])
+    if op == 'movq' and args[0] == args[1]:
+        return 1, []
+
+def store_reload(lines, i):
+    """movq R, X; movq X, R  ->  movq R, X"""
+    if i + 1 >= len(lines):
+        return
+    op1, args1 = parse(lines[i])
+    op2, args2 = parse(lines[i + 1])
+    if op1 == op2 == 'movq' and is_register(args1[0]) and args1 == args2[::-1]:
+        return 2, [lines[i]]
+
+def jump_to_next(lines, i):
+    """jmp L; L:  ->  L:"""
+    if i + 1 >= len(lines):
+        return
+    op, args = parse(lines[i])
+    if op == 'jmp' and lines[i + 1] == f'{args[0]}:':
+        return 1, []
+
+def branch_over_jump(lines, i):
+    """jCC A; jmp B; A:  ->  jNCC B; A:"""
+    if i + 2 >= len(lines):
+        return
+    op1, args1 = parse(lines[i])
+    op2, args2 = parse(lines[i + 1])
+    if op1 in inverted and op2 == 'jmp' and lines[i + 2] == f'{args1[0]}:':
+        return 2, [f'{inverted[op1]} {args2[0]}']
+
+def scratch_copy(lines, i):
+    """movq A, %r11; movq %r11, B  ->  movq A, B  (if A and B are not both in memory,
+    and a 64-bit immediate A is not stored to memory)"""
+    if i + 1 >= len(lines):
+        return
+    op1, args1 = parse(lines[i])
+    op2, args2 = parse(lines[i + 1])
+    if (op1 == op2 == 'movq' and args1[1] == '%r11' and args2[0] == '%r11' and args2[1] != '%r11'
+            and not (is_memory(args1[0]) and is_memory(args2[1]))
+            and not (is_wide_immediate(args1[0]) and is_memory(args2[1])) and scratch_dead(lines, i + 2)):
+        return 2, [f'movq {args1[0]}, {args2[1]}']
+
+def scratch_op(lines, i):
+    """movq A, %r11; OP B, %r11; movq %r11, R  ->  movq A, R; OP B, R
+    for a register R that B does not use; likewise for unary operations"""
+    if i + 2 >= len(lines):
+        return
+    op1, args1 = parse(lines[i])
+    op2, args2 = parse(lines[i + 1])
+    op3, args3 = parse(lines[i + 2])
+    if not (op1 == op3 == 'movq' and args1[1] == '%r11' and args3[0] == '%r11'):
+        return
+    target = args3[1]
+    if not is_register(target) or target == '%r11' or not scratch_dead(lines, i + 3):
+        return
+    if op2 in ('addq', 'subq', 'andq', 'orq', 'xorq', 'imulq') and len(args2) == 2 and args2[1] == '%r11':
+        if target in args2[0] or '%r11' in args2[0]:
+            return
+        return 3, [f'movq {args1[0]}, {target}', f'{op2} {args2[0]}, {target}']
+    if op2 in ('negq', 'notq') and args2 == ('%r11',):
+        return 3, [f'movq {args1[0]}, {target}', f'{op2} {target}']
+
+def scratch_compare(lines, i):
+    """movq B, %r11; cmpq %r11, A  ->  cmpq B, A  (if A and B are not both in memory,
+    and B is not a 64-bit immediate)"""
+    if i + 1 >= len(lines):
+        return
+    op1, args1 = parse(lines[i])
+    op2, args2 = parse(lines[i + 1])
+    if (op1 == 'movq' and op2 == 'cmpq' and args1[1] == '%r11' and args2[0] == '%r11'
+            and not (is_memory(args1[0]) and is_memory(args2[1]))
+            and not is_wide_immediate(args1[0]) and scratch_dead(lines, i + 2)):
+        return 2, [f'cmpq {args1[0]}, {args2[1]}']
+
+patterns = [
+    ('self_move', self_move),
+    ('store_reload', store_reload),
+    ('jump_to_next', jump_to_next),
+    ('branch_over_jump', branch_over_jump),
+    ('scratch_copy', scratch_copy),
+    ('scratch_op', scratch_op),
+    ('scratch_compare', scratch_compare),
+]
+
+def peephole(lines, counts=None, patterns=patterns):
+    """Apply `patterns' to the assembly `lines' until none applies. The
+    number of rewrites of each pattern is added to the dict `counts'."""
+    changed = True
+    while changed:
+        changed = False
+        result = []
+        i = 0
+        while i < len(lines):
+            for name, pattern in patterns:
+                rewrite = pattern(lines, i)
+                if rewrite is not None:
+                    break
+            else:
+                result.append(lines[i])
+                i += 1
+                continue
+            n, replacement = rewrite
+            result += replacement
+            i += n
+            changed = True
+            if counts is not None:
+                counts[name] = counts.get(name, 0) + 1
+        lines = result
+    return lines
@@ -0,0 +1,176 @@
+#! /usr/bin/env python3
+
+#--------- Register allocation ---------#
+# Linear scan (Poletto & Sarkar) over the live intervals of the temporaries of
+# one TAC procedure. The interval of a temporary spans every instruction it is
+# live at, computed by a backward liveness analysis over the TAC itself (jumps
+# go to their label, ret ends the procedure). Temporaries that do not get a
+# register are spilled to a stack slot by Tox64.lookup_tmp.
+#
+# Registers reserved by the code generator are never allocated: %rax and %rdx
+# (mul, div, mod, return values and exception status), %rcx (shifts) and %r11
+# (scratch). On top of that, an interval that is live across a call cannot use
+# a caller-saved register, and one that overlaps the passing of the arguments
+# of a call (from `param k' to the `call') cannot use the register of
+# argument k.
+
+import bisect
+
+binop_codes = {'add', 'sub', 'mul', 'div', 'mod', 'and', 'or', 'xor', 'shl', 'shr'}
+unop_codes = {'neg', 'not'}
+jump_codes = {'jl', 'jg', 'jle', 'jge', 'jz', 'jnz'}
+
+arg_registers = ['%rdi', '%rsi', '%rdx', '%rcx', '%r8', '%r9']
+# allocatable registers, in order of preference
+caller_saved_regs = ['%r10', '%r9', '%r8', '%rsi', '%rdi']
+callee_saved_regs = ['%rbx', '%r12', '%r13', '%r14', '%r15']
+
+
+def is_temp(arg):
+    return type(arg) == str and arg.startswith('%')
+
+def uses_defs(instr):
+    """Temporaries read and written by the TAC instruction `instr'"""
+    opcode, args, result = instr['opcode'], instr['args'], instr['result']
+    if opcode in ('const', 'call'):
+        uses = []
+    elif opcode == 'param':
+        uses = args[1:]
+    elif opcode == 'jtab':
+        uses = args[1:2]
+    elif opcode in ('copy', 'cmpq', 'ret', 'lea', 'setexc') or opcode in binop_codes or opcode in unop_codes:
+        uses = args
+    else:
+        uses = []
+    return [a for a in uses if is_temp(a)], [result] if is_temp(result) else []
+
+def liveness(body):
+    """Temporaries live on entry of each instruction of `body'"""
+    labels = {instr['args'][0]: i for i, instr in enumerate(body) if instr['opcode'] == 'label'}
+    n = len(body)
+    succs = []
+    for i, instr in enumerate(body):
+        opcode = instr['opcode']
+        if opcode == 'jmp':
+            succs.append([labels[instr['args'][0]]])
+        elif opcode == 'jtab':
+            succs.append([labels[l] for l in instr['args'][:1] + instr['args'][2:]])
+        elif opcode in jump_codes:
+            succs.append([labels[instr['args'][0]]] + ([i + 1] if i + 1 < n else []))
+        elif opcode == 'ret':
+            succs.append([])
+        else:
+            succs.append([i + 1] if i + 1 < n else [])
+    uses = []
+    defs = []
+    for instr in body:
+        u, d = uses_defs(instr)
+        uses.append(set(u))
+        defs.append(set(d))
+    live_in = [set() for _ in body]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(n - 1, -1, -1):
+            live_out = set()
+            for s in succs[i]:
+                live_out |= live_in[s]
+            new = (live_out - defs[i]) | uses[i]
+            if new != live_in[i]:
+                live_in[i] = new
+                changed = True
+    return live_in, defs
+
+def intervals(body):
+    """Map each temporary to its live interval (first, last) in `body'"""
+    live_in, defs = liveness(body)
+    result = {}
+    for i in range(len(body)):
+        for t in live_in[i] | defs[i]:
+            if t in result:
+                result[t][1] = i
+            else:
+                result[t] = [i, i]
+    return result
+
+def call_sites(body):
+    """List of (call position, [(param position, argument register)])"""
+    sites = []
+    params = []
+    for i, instr in enumerate(body):
+        if instr['opcode'] == 'param':
+            k = instr['args'][0]
+            if k <= 6:
+                params.append((i, arg_registers[k - 1]))
+        elif instr['opcode'] == 'call':
+            sites.append((i, params))
+            params = []
+    return sites
+
+def allocate(body, args=()):
+    """Assign registers to the temporaries of the procedure body `body' whose
+    parameters are `args'. Returns the mapping temporary -> register; the
+    temporaries missing from it must live on the stack"""
+    live = intervals(body)
+    for arg in args:
+        if arg in live:
+            live[arg][0] = -1       # defined on entry
+    sites = call_sites(body)
+    calls = [call for call, _ in sites]
+    forbidden = {}
+    for t, (start, end) in live.items():
+        # first call after the start of the interval
+        i = bisect.bisect_right(calls, start)
+        if i < len(calls) and calls[i] < end:
+            forbidden[t] = caller_saved_regs
+        elif i < len(calls):
+            forbidden[t] = {reg for param, reg in sites[i][1] if end > param}
+        else:
+            forbidden[t] = ()
+
+    registers = {}
+    active = []     # (end, temporary) of the intervals currently in a register
+    free = caller_saved_regs + callee_saved_regs
+    for t in sorted(live, key=lambda t: (live[t][0], t)):
+        start, end = live[t]
+        # expire the intervals that ended, their registers are free again
+        for interval in [a for a in active if a[0] <= start]:
+            active.remove(interval)
+            free.append(registers[interval[1]])
+        choices = [r for r in free if r not in forbidden[t]]
+        if choices:
+            # intervals that do not cross calls prefer caller-saved registers, which need no saving
+            reg = min(choices, key=lambda r: (r in callee_saved_regs, free.index(r)))
+            free.remove(reg)
+            registers[t] = reg
+            active.append((end, t))
+            continue
+        # spill whichever of t and the active intervals it could replace ends last
+        candidates = [a for a in active if registers[a[1]] not in forbidden[t]]
+        if candidates:
+            victim = max(candidates)
+            if victim[0] > end:
+                active.remove(victim)
+                registers[t] = registers.pop(victim[1])
+                active.append((end, t))
+    return registers
+
+def sequentialize(moves, scratch='%r11'):
+    """Order the parallel moves `moves' (list of (source, destination), the
+    sources being registers) so that no source is overwritten before it is
+    read, breaking cycles through `scratch'. Returns a list of movq."""
+    moves = [(src, dst) for src, dst in moves if src != dst]
+    result = []
+    while moves:
+        sources = {src for src, _ in moves}
+        for i, (src, dst) in enumerate(moves):
+            if dst not in sources:
+                result.append(f'movq {src}, {dst}')
+                del moves[i]
+                break
+        else:
+            # every destination is still to be read: a cycle
+            src, dst = moves[0]
+            result.append(f'movq {src}, {scratch}')
+            moves = [(scratch if s == src else s, d) for s, d in moves]
+    return result
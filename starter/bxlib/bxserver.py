@@ -0,0 +1,133 @@
+#! /usr/bin/env python3
+
+#--------- Compile server ---------#
+# A warm daemon listening on a Unix socket. Requests and responses are single
+# lines of JSON:
+#   request:  {"filename": str, "source": str, "opt_level": int, "emit_tac": bool,
+#              "time_passes": bool, "pass_memory": bool}
+#   response: {"status": int, "asm": str | null, "tac": list | null,
+#              "opt_tac": list | null, "diagnostics": dict | null, "stats": dict | null}
+# where diagnostics and stats have the same shape as the ones returned by
+# bxc.compile_file.
+
+import os
+import sys
+import json
+import stat
+import socket
+import traceback
+
+from bxlib.bxerrors import Reporter
+from bxlib.bxstats import PassStats
+
+# asyncio, the process pool and the compiler itself are only imported by the
+# server side: clients just need `request'
+
+# Compiler of the current worker process, built once by init_worker
+worker_compiler = None
+
+def init_worker():
+    # imported here so that clients importing this module do not load the compiler
+    from bxlib.bxcompiler import Compiler
+    global worker_compiler
+    worker_compiler = Compiler()
+
+def compile_request(request):
+    """Run one request in a worker process and return the response"""
+    reporter = Reporter()
+    try:
+        reporter.filename = request['filename']
+        reporter.source = request['source']
+        tac_out = {} if request.get('emit_tac') else None
+        stats = PassStats(request['filename']) if request.get('time_passes') else None
+        worker_compiler.opt_level = request.get('opt_level', 2)
+        asm = worker_compiler.compile(reporter, request['source'], tac_out, stats=stats)
+        if stats is not None and request.get('pass_memory') and reporter.error_number == 0:
+            stats.measure_memory(lambda traced: worker_compiler.compile(Reporter(), request['source'], stats=traced))
+    except Exception:
+        return {'status': 1, 'asm': None, 'tac': None, 'opt_tac': None, 'stats': None,
+                'diagnostics': {'stage': reporter.stage, 'errors': reporter.errors, 'message': traceback.format_exc()}}
+    response = {'status': 0, 'asm': asm, 'tac': None, 'opt_tac': None, 'diagnostics': None,
+                'stats': stats.as_dict() if stats is not None else None}
+    if tac_out:
+        response['tac'] = tac_out.get('tac')
+        response['opt_tac'] = tac_out.get('opt_tac')
+    if reporter.error_number != 0:
+        response['status'] = 1
+        response['diagnostics'] = {'stage': reporter.stage, 'errors': reporter.errors, 'message': reporter.summary()}
+    return response
+
+async def handle_client(reader, writer, pool):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    try:
+        while line := await reader.readline():
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('expected a JSON object')
+                for key in ('filename', 'source'):
+                    if not isinstance(request.get(key), str):
+                        raise ValueError(f'missing or non-string "{key}"')
+            except ValueError as e:
+                response = {'status': 1, 'asm': None, 'tac': None, 'opt_tac': None, 'stats': None,
+                            'diagnostics': {'stage': None, 'errors': [], 'message': f'Error: bad request: {e}'}}
+            else:
+                response = await loop.run_in_executor(pool, compile_request, request)
+            writer.write(json.dumps(response).encode('utf-8') + b'\n')
+            await writer.drain()
+    finally:
+        writer.close()
+
+async def run_server(path, jobs):
+    import asyncio
+    from concurrent.futures import ProcessPoolExecutor
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as pool:
+        # start every worker now rather than on the first requests
+        await asyncio.gather(*(loop.run_in_executor(pool, os.getpid) for _ in range(jobs)))
+        server = await asyncio.start_unix_server(lambda r, w: handle_client(r, w, pool), path=path,
+                                                 limit=1 << 26)
+        async with server:
+            await server.serve_forever()
+
+def serve(path, jobs=1):
+    """Serve compilation requests on the Unix socket `path' until interrupted,
+    compiling up to `jobs' requests concurrently"""
+    import asyncio
+    if os.path.exists(path):
+        # only a socket nobody listens on is stale; anything else is left alone
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            print(f'Error: {path} exists and is not a socket', file=sys.stderr)
+            sys.exit(1)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(path)
+            except ConnectionRefusedError:
+                os.remove(path)     # stale socket of a previous server
+            except OSError as e:
+                print(f'Error: cannot check the socket {path}: {e}', file=sys.stderr)
+                sys.exit(1)
+            else:
+                print(f'Error: a server is already listening on {path}', file=sys.stderr)
+                sys.exit(1)
+    try:
+        asyncio.run(run_server(path, jobs))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+def request(path, payload, timeout=None):
+    """Send one request to the server at `path' and return its response.
+    Raises OSError if no server is listening."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps(payload).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError(f'Server at {path} closed the connection')
+    return json.loads(line)
@@ -0,0 +1,129 @@
+#! /usr/bin/env python3
+
+#--------- Pass statistics ---------#
+# Wall-clock time and peak memory of each compiler stage, plus a few size
+# counters, collected by Compiler.compile when it is given a PassStats
+# (bxc.py --time-passes). Memory is the peak of the Python heap while the
+# stage ran, as measured by tracemalloc. Its allocation hooks slow the
+# stages down several times, so the memory is only measured on request
+# (--pass-memory), in a second compilation that is not timed: see
+# PassStats.measure_memory.
+
+import time
+import tracemalloc
+import dataclasses as dc
+from contextlib import contextmanager
+
+from bxlib.bxast import AST
+
+# Stages in the order they run (the names of reporter.stage)
+stages = ['Parsing', 'Type Check', 'Transforming AST to TAC', 'CFG', 'TAC to x64']
+
+
+class PassStats:
+    def __init__(self, filename=None, trace_memory=False):
+        self.filename = filename
+        # whether stage() records the peak memory instead of the time
+        self.trace_memory = trace_memory
+        self.times = {}     # stage -> seconds (summed over repeated entries)
+        self.memory = {}    # stage -> peak bytes, only filled by measure_memory
+        self.tokens = 0
+        self.ast_nodes = 0
+        self.tac_instructions = {}  # procedure -> number of TAC instructions
+        self.cfg_blocks = {}        # procedure -> (blocks before, blocks after) CFG.optimise
+        self.stack_slots = {}       # procedure -> stack slots used by Tox64
+        self.peephole = {}          # peephole pattern -> number of rewrites
+
+    @contextmanager
+    def stage(self, name):
+        """Time the body of the with statement and charge it to stage `name',
+        or with `trace_memory', record its peak memory instead"""
+        if self.trace_memory:
+            with self._trace(name):
+                yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.times[name] = self.times.get(name, 0.0) + elapsed
+
+    @contextmanager
+    def _trace(self, name):
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            _, peak = tracemalloc.get_traced_memory()
+            if not tracing:
+                tracemalloc.stop()
+            self.memory[name] = max(self.memory.get(name, 0), peak)
+
+    def measure_memory(self, compile):
+        """Fill self.memory by calling `compile(stats)' again with statistics
+        that trace the memory; the times and sizes of self are kept"""
+        traced = PassStats(self.filename, trace_memory=True)
+        compile(traced)
+        self.memory = traced.memory
+
+    def as_dict(self):
+        """The statistics as plain JSON-serialisable data"""
+        return {
+            'file': self.filename,
+            'stages': [{'stage': name, 'seconds': self.times[name], 'peak_bytes': self.memory.get(name)}
+                       for name in stages if name in self.times],
+            'tokens': self.tokens,
+            'ast_nodes': self.ast_nodes,
+            'peephole': self.peephole,
+            'procedures': {proc: {'tac_instructions': self.tac_instructions.get(proc),
+                                  'cfg_blocks_before': self.cfg_blocks.get(proc, (None, None))[0],
+                                  'cfg_blocks_after': self.cfg_blocks.get(proc, (None, None))[1],
+                                  'stack_slots': self.stack_slots.get(proc)}
+                           for proc in self.procedures()},
+        }
+
+    def procedures(self):
+        seen = {}
+        for counts in (self.tac_instructions, self.cfg_blocks, self.stack_slots):
+            for proc in counts:
+                seen[proc] = None
+        return list(seen)
+
+
+def format_table(data):
+    """Render the result of PassStats.as_dict as a human readable table"""
+    memory = any(entry['peak_bytes'] is not None for entry in data['stages'])
+    lines = [f'===== Pass timings: {data["file"]} =====',
+             f'{"stage":<26}{"time (ms)":>12}' + (f'{"peak (KiB)":>14}' if memory else '')]
+    total = 0.0
+    for entry in data['stages']:
+        total += entry['seconds']
+        line = f'{entry["stage"]:<26}{1000 * entry["seconds"]:>12.2f}'
+        if entry['peak_bytes'] is not None:
+            line += f'{entry["peak_bytes"] / 1024:>14.1f}'
+        lines.append(line)
+    lines.append(f'{"total":<26}{1000 * total:>12.2f}')
+    lines.append(f'tokens: {data["tokens"]}   AST nodes: {data["ast_nodes"]}')
+    if data['peephole']:
+        lines.append('peephole rewrites: ' + ', '.join(f'{name} {n}' for name, n in data['peephole'].items()))
+    if data['procedures']:
+        lines.append(f'{"procedure":<26}{"TAC":>8}{"blocks":>10}{"opt":>8}{"slots":>8}')
+        for proc, counts in data['procedures'].items():
+            row = [counts['tac_instructions'], counts['cfg_blocks_before'],
+                   counts['cfg_blocks_after'], counts['stack_slots']]
+            row = ['-' if n is None else n for n in row]
+            lines.append(f'{proc:<26}{row[0]:>8}{row[1]:>10}{row[2]:>8}{row[3]:>8}')
+    return '\n'.join(lines)
+
+
+def count_nodes(node):
+    """Number of AST nodes in `node'"""
+    if type(node) == list:
+        return sum(count_nodes(item) for item in node)
+    if not isinstance(node, AST):
+        return 0
+    return 1 + sum(count_nodes(getattr(node, f.name)) for f in dc.fields(node))
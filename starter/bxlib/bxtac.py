@@ -1,8 +1,17 @@
 #! /usr/bin/env python3
 from bxlib.bxast import *
-import hashlib
 
 boolOp= {'<': 'jl','>': 'jg','<=': 'jle','>=': 'jge','==': 'jz','!=': 'jnz'}
+# Procedures that may raise return their exception status (0 for none) with
+# `setexc' right before each ret, and their callers read it with `getexc'
+# right after the call (Tox64 passes it in %rdx, next to the return value).
+# Inside a procedure the status lives in this temporary; the @exception
+# global is only written when an exception escapes main.
+exception_tmp = '%.exception'
+# try statements with more handlers than this dispatch on the exception id
+# with a jump table (`jtab default, x, L0, L1, ..' jumps to L<x>, or to
+# default when x is out of range) instead of a chain of comparisons
+jump_table_threshold = 4
 
 class Scope:
     def __init__(self):
@@ -13,7 +22,7 @@ class Scope:
 
 
 class ToTac:
-    def __init__(self, functions, reporter):
+    def __init__(self, functions, reporter, may_raise=None, exception_ids=None):
         self.tmp_counter = 0
         self.label_counter = 0
         self.body = []
@@ -24,11 +33,28 @@ class ToTac:
         self.reporter = reporter
         self.proc = 'Global'
         self.functions = functions
-
-    def hash_exception(self, name):
-        h = hashlib.shake_256(name.encode('utf-8'))
-        i = int(h.hexdigest(3), 16)
-        return i
+        # procedures whose calls must be followed by an exception check, None for all
+        self.may_raise = may_raise
+        # exception -> id, numbered densely from 1 by the TypeChecker
+        self.exception_ids = {} if exception_ids is None else exception_ids
+
+    def raises(self, name):
+        """Whether the procedure `name' follows the exception status convention
+        (the runtime procedures never raise)"""
+        if self.may_raise is None:
+            return not name.startswith('__bx_')
+        return name in self.may_raise
+
+    def new_label(self):
+        # labels are numbered per procedure and prefixed with its name, so the
+        # code of a procedure does not depend on the procedures before it
+        self.label_counter += 1
+        return f'{self.proc}_{self.label_counter - 1}'
+
+    def exception_id(self, name):
+        if name not in self.exception_ids:
+            self.exception_ids[name] = len(self.exception_ids) + 1
+        return self.exception_ids[name]
 
     def emit(self, opcode, args, result):
         self.body.append({"opcode": opcode, "args": args, "result": result})
@@ -39,9 +65,12 @@ class ToTac:
                 return scope.variables[name]
         self.reporter.report(f"Undefined variable {name}", -1, self.reporter.stage)
 
-    def processProgram(self, p):
+    def processPrologue(self):
         self.tac.append({"var": f'@exception', "init": 0})
         self.scopes[-1].variables["exception"] = '@exception'
+
+    def processProgram(self, p):
+        self.processPrologue()
         for decl in p:
             self.processDeclaration(decl)
 
@@ -78,10 +107,17 @@ class ToTac:
 
         elif type(s) == ProcDecl:
             r = [name for p in s.args for name in p.name]
+            self.scopes.append(Scope())
             for x in r:
                 self.scopes[-1].variables[x] = f'%{x}'
             self.proc = s.name
+            self.tmp_counter = 0
+            self.label_counter = 0
             self.processBlock(s.block)
+            if self.raises(s.name) and (self.body == [] or self.body[-1]['opcode'] not in ('ret', 'jmp')):
+                # the ret the CFG would add at the end must set the status too
+                self.emitReturn([])
+            self.scopes.pop()
             self.tac.append({"proc": f'@{s.name}', "args": [f'%{x}' for x in r], "body": self.body})
             self.body = []
 
@@ -107,10 +143,9 @@ class ToTac:
             self.processBlock(s)
 
         elif type(s) == Ifelse:
-            lab_true = self.label_counter
-            lab_false = self.label_counter + 1
-            lab_over =  self.label_counter +2
-            self.label_counter += 3
+            lab_true = self.new_label()
+            lab_false = self.new_label()
+            lab_over = self.new_label()
 
             condition = self.processBool(s.condition, lab_true, lab_false)
             self.emit("label", [lab_true], None)
@@ -122,10 +157,9 @@ class ToTac:
 
         
         elif type(s) == While:
-            lab_head = self.label_counter
-            lab_body = self.label_counter + 1
-            lab_end =  self.label_counter +2
-            self.label_counter += 3
+            lab_head = self.new_label()
+            lab_body = self.new_label()
+            lab_end = self.new_label()
             self.whiles.append((lab_head, lab_end))
             self.emit("label", [lab_head], None)
             condition = self.processBool(s.condition, lab_body, lab_end)
@@ -153,15 +187,14 @@ class ToTac:
 
         elif type(s) == Return:
             if s.value == None:
-                self.emit("ret", [], None)
+                self.emitReturn([])
             else:
                 value = self.processExpression(s.value)
-                self.emit("ret", [value], None)
+                self.emitReturn([value])
 
         elif type(s) == TryExcept:
-            lab_exceptions = self.label_counter
-            lab_end =  self.label_counter +1
-            self.label_counter += 2
+            lab_exceptions = self.new_label()
+            lab_end = self.new_label()
             
             self.exceptions_stack.append((lab_exceptions,lab_end))
 
@@ -170,62 +203,29 @@ class ToTac:
             self.exceptions_stack.pop()
 
             self.emit("label", [lab_exceptions], None)
+            if len(s.catches) > jump_table_threshold:
+                self.processCatchTable(s.catches, lab_end)
+            else:
+                self.processCatchChain(s.catches, lab_end)
 
-
-
-            for c in s.catches:
-                lab_false =  self.label_counter
-                self.label_counter += 1
-                var = '@exception'
-                h = self.hash_exception(c.name)
-                tmp = f'%{self.tmp_counter}'
-                self.tmp_counter += 1
-                self.emit('const', [h], tmp)
-                self.emit('cmpq', [tmp, var], None)
-                self.emit('jnz', [lab_false], None)
-                tmp = f'%{self.tmp_counter}'
-                self.tmp_counter += 1
-                self.emit('const', [0], tmp)
-                self.emit("copy", [tmp], var)
-                self.processStatement(c.block)
-                self.emit("jmp", [lab_end], None)
-                self.emit("label", [lab_false], None)
-
-            
             tmp = f'%{self.tmp_counter}'
             self.tmp_counter += 1
-            var = '@exception'
+            var = exception_tmp
 
             self.emit('const', [0], tmp)
-            self.emit('cmpq', [tmp, var], None)
+            self.emit('cmpq', [var, tmp], None)
             self.emit('jz', [lab_end], None)
-
-            if self.exceptions_stack == []:
-                if self.proc in self.functions['Function']:
-                    self.emit("ret", [tmp], None)
-                else:
-                    self.emit("ret", [], None)
-            else:
-                label = self.exceptions_stack[-1][0]
-                self.emit("jmp", [label], None)
-                
+            self.propagateException()
             self.emit("label", [lab_end], None)
 
         elif type(s) == Raise:
-            var = '@exception'
+            var = exception_tmp
             tmp = f'%{self.tmp_counter}'
             self.tmp_counter += 1
-            h = self.hash_exception(s.name)
+            h = self.exception_id(s.name)
             self.emit('const', [h], tmp)
             self.emit("copy", [tmp], var)
-            if self.exceptions_stack == []:
-                if self.proc in self.functions['Function']:
-                    self.emit("ret", [tmp], None)
-                else:
-                    self.emit("ret", [], None)
-            else:
-                label = self.exceptions_stack[-1][0]
-                self.emit("jmp", [label], None)
+            self.propagateException()
         
         else:
             self.reporter.report(f'Unrecognized statement: {type(s)}', s.line, self.reporter.stage)
@@ -287,24 +287,19 @@ class ToTac:
             else:
                 self.emit('call', [f'@{e.name}', len(e.args)+1], None)
 
+            if not self.raises(e.name):
+                return return_value
+
             tmp = f'%{self.tmp_counter}'
-            lab_no_exception =  self.label_counter
-            self.label_counter += 1
+            lab_no_exception = self.new_label()
             self.tmp_counter += 1
-            var = '@exception'
+            var = exception_tmp
 
+            self.emit('getexc', [], var)
             self.emit('const', [0], tmp)
-            self.emit('cmpq', [tmp, var], None)
+            self.emit('cmpq', [var, tmp], None)
             self.emit('jz', [lab_no_exception], None)
-
-            if self.exceptions_stack == []:
-                if self.proc in self.functions['Function']:
-                    self.emit("ret", [tmp], None)
-                else:
-                    self.emit("ret", [], None)
-            else:
-                label = self.exceptions_stack[-1][0]
-                self.emit("jmp", [label], None)
+            self.propagateException()
             self.emit("label", [lab_no_exception], None)
 
             return return_value
@@ -313,6 +308,69 @@ class ToTac:
         else:
             self.reporter.report(f'Unrecognized expression: {type(e)}', e.line, self.reporter.stage)
 
+    def processCatchChain(self, catches, lab_end):
+        """Test the exception against each handler of `catches' in turn"""
+        for c in catches:
+            lab_false = self.new_label()
+            var = exception_tmp
+            h = self.exception_id(c.name)
+            tmp = f'%{self.tmp_counter}'
+            self.tmp_counter += 1
+            self.emit('const', [h], tmp)
+            self.emit('cmpq', [var, tmp], None)
+            self.emit('jnz', [lab_false], None)
+            tmp = f'%{self.tmp_counter}'
+            self.tmp_counter += 1
+            self.emit('const', [0], tmp)
+            self.emit("copy", [tmp], var)
+            self.processStatement(c.block)
+            self.emit("jmp", [lab_end], None)
+            self.emit("label", [lab_false], None)
+
+    def processCatchTable(self, catches, lab_end):
+        """Jump to the handler of the exception through a table indexed by its id"""
+        lab_none = self.new_label()
+        table = [lab_none] * (max(self.exception_id(c.name) for c in catches) + 1)
+        labels = []
+        for c in catches:
+            # the TypeChecker rejects exceptions caught twice
+            labels.append(self.new_label())
+            table[self.exception_id(c.name)] = labels[-1]
+        self.emit('jtab', [lab_none, exception_tmp] + table, None)
+        for lab, c in zip(labels, catches):
+            self.emit("label", [lab], None)
+            tmp = f'%{self.tmp_counter}'
+            self.tmp_counter += 1
+            self.emit('const', [0], tmp)
+            self.emit("copy", [tmp], exception_tmp)
+            self.processStatement(c.block)
+            self.emit("jmp", [lab_end], None)
+        self.emit("label", [lab_none], None)
+
+    def emitReturn(self, args):
+        """Return `args', with no exception if the callers expect a status"""
+        if self.raises(self.proc):
+            tmp = f'%{self.tmp_counter}'
+            self.tmp_counter += 1
+            self.emit('const', [0], tmp)
+            self.emit('setexc', [tmp], None)
+        self.emit("ret", args, None)
+
+    def propagateException(self):
+        """Jump to the innermost handler, or return the exception status to
+        the caller (to the runtime through @exception in main)"""
+        if self.exceptions_stack != []:
+            label = self.exceptions_stack[-1][0]
+            self.emit("jmp", [label], None)
+            return
+        if self.proc == 'main':
+            self.emit("copy", [exception_tmp], '@exception')
+        self.emit('setexc', [exception_tmp], None)
+        if self.proc in self.functions['Function']:
+            self.emit("ret", [exception_tmp], None)
+        else:
+            self.emit("ret", [], None)
+
     def getBinOp(self, op):
         if op == '+': return "add"
         elif op == '-': return "sub"
@@ -351,7 +409,7 @@ class ToTac:
                 tmp = f'%{self.tmp_counter}'
                 self.tmp_counter += 1
                 self.emit('const', [0], tmp)
-                self.emit('cmpq', [tmp, var], None)
+                self.emit('cmpq', [var, tmp], None)
                 self.emit('jnz', [lab_true], None)
                 self.emit('jmp', [lab_false], None)
             elif e.operation in boolOp.keys():
@@ -365,15 +423,15 @@ class ToTac:
                 self.processBool(e.value, lab_false, lab_true)
             
             elif e.operation == '&&':
-                self.processBool(e.left, self.label_counter, lab_false)
-                self.emit('label', [self.label_counter], None)
-                self.label_counter += 1
+                lab_right = self.new_label()
+                self.processBool(e.left, lab_right, lab_false)
+                self.emit('label', [lab_right], None)
                 self.processBool(e.right, lab_true, lab_false)
 
             elif e.operation == '||':
-                self.processBool(e.left, lab_true, self.label_counter)
-                self.emit('label', [self.label_counter], None)
-                self.label_counter += 1
+                lab_right = self.new_label()
+                self.processBool(e.left, lab_true, lab_right)
+                self.emit('label', [lab_right], None)
                 self.processBool(e.right, lab_true, lab_false)
 
     def getData(self):
@@ -2,6 +2,7 @@
 
 from bxlib.bxast import *
 from bxlib.bxerrors import Reporter
+from bxlib.bxcallgraph import may_raise
 
 bool_op = ['||','&&','<','>','<=','>=','!','==','!=']
 int_op = ['|','^','&','<<','>>','+','-','*','/','%','-','~']
@@ -55,7 +56,11 @@ class TypeChecker:
         self.reporter = reporter
         self.proc = None
         self.exceptions = set()
+        self.exception_ids = {} # exception -> dense id from 1 in declaration order, 0 is no exception
         self.functions = {'Function': [], 'Subroutine': []}
+        self.calls = {}         # procedure -> procedures it calls
+        self.raisers = set()    # procedures containing a raise statement
+        self.may_raise = set()  # procedures that may return with an exception, see bxcallgraph
 
     def is_declared(self, name):
         for scope in reversed(self.scopes):
@@ -93,6 +98,7 @@ class TypeChecker:
                     self.reporter.report(f'Exception {name} defined twice.', decl.line , self.reporter.stage)
                 else:
                     self.exceptions.add(name)
+                    self.exception_ids[name] = len(self.exception_ids) + 1
 
 
     def get_processes(self, p):
@@ -142,6 +148,10 @@ class TypeChecker:
             return raises
         for decl in p:
             self.for_decl(decl)
+        # the runtime procedures have no body, trust their raises clause
+        raisers = self.raisers | {name for name, ty in self.procedures.items()
+                                  if name not in self.calls and ty.raise_list}
+        self.may_raise = may_raise(self.calls, raisers)
 
 
     def for_decl(self, decl):
@@ -179,6 +189,7 @@ class TypeChecker:
 
     def for_procDecl(self, decl):
         self.proc = decl.name
+        self.calls[decl.name] = set()
         self.for_block(decl.block, decl.args, self.procedures[decl.name].raise_list)
         self.proc = None
 
@@ -276,6 +287,7 @@ class TypeChecker:
                 self.reporter.report(f'Raising undeclared escaping exception {s.name}', s.line, self.reporter.stage)
                 return raises
             raises += [s.name]
+            self.raisers.add(self.proc)
 
         elif type(s) == Catch:
             if s.name not in self.exceptions:
@@ -392,6 +404,8 @@ class TypeChecker:
                     return raises
             e.ty = self.procedures[e.name].return_type
             raises += self.procedures[e.name].raise_list
+            if self.proc is not None:
+                self.calls[self.proc].add(e.name)
 
         else:
             self.reporter.report(f'Unidentified expression: {e}', e.line, self.reporter.stage)
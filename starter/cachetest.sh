@@ -0,0 +1,65 @@
+#!/bin/bash
+
+# Check that --cache-dir never changes the assembly: a warm compilation
+# (whole file hit) and an incremental one after an edit (procedure hits) must
+# give the same assembly as a cold compilation without cache.
+#
+# The edits are in the "incremental" folder: NAME.before.bx is compiled into
+# the cache first, then NAME.after.bx, which changes a declaration that some
+# procedures depend on while leaving their text as it was.
+
+work=$(mktemp -d)
+
+# Compile $1 with the remaining arguments and keep the assembly in $work/$2.s
+compile() {
+    src=$1
+    out=$2
+    shift 2
+    python3 bxc.py "$@" "$src"
+    if [ ! -f "${src%.bx}.x64-linux.s" ]; then
+        echo "Error: ${src%.bx}.x64-linux.s not created for $src $*."
+        return 1
+    fi
+    mv "${src%.bx}.x64-linux.s" "$work/$out.s"
+}
+
+# Compare the assembly $work/$1.s to the cold one in $work/cold.s
+check() {
+    if cmp -s "$work/cold.s" "$work/$1.s"; then
+        echo "Success: $1 assembly for $2 is correct."
+    else
+        echo "Error: $1 assembly for $2 differs from a cold compilation."
+        diff "$work/cold.s" "$work/$1.s" | head -20
+    fi
+}
+
+# The cache is kept across the optimisation levels of a file, which must not
+# share entries
+for bx_file in examples/*.bx; do
+    rm -rf "$work/cache"
+    for opt in 0 1 2; do
+        # Whole file hits: compiling a second time must give the stored assembly
+        compile "$bx_file" cold -O$opt || continue
+        compile "$bx_file" fill -O$opt --cache-dir "$work/cache" || continue
+        compile "$bx_file" warm -O$opt --cache-dir "$work/cache" || continue
+        check fill "$bx_file at -O$opt"
+        check warm "$bx_file at -O$opt"
+    done
+done
+
+# Procedure hits: after the edit, the unchanged procedures come from the
+# cache, and those depending on what changed must not
+for before in incremental/*.before.bx; do
+    after=${before%.before.bx}.after.bx
+    rm -rf "$work/cache"
+    for opt in 0 1 2; do
+        cp "$before" "$work/prog.bx"
+        compile "$work/prog.bx" fill -O$opt --cache-dir "$work/cache" || continue
+        cp "$after" "$work/prog.bx"
+        compile "$work/prog.bx" cold -O$opt || continue
+        compile "$work/prog.bx" incremental -O$opt --cache-dir "$work/cache" || continue
+        check incremental "$after at -O$opt"
+    done
+done
+
+rm -rf "$work"
@@ -14,9 +14,9 @@ for bx_file in examples/*.bx; do
     # Run the first command
     python3 bxc.py "$bx_file"
 
-    # Check if the required 'source.tac.json' file is created
-    if [ ! -f "$base_name.tac.json" ]; then
-        echo "Error: source.tac.json not created, skipping further processing for $bx_file."
+    # Check if the required 'source.x64-linux.s' file is created
+    if [ ! -f "$base_name.x64-linux.s" ]; then
+        echo "Error: source.x64-linux.s not created, skipping further processing for $bx_file."
         break  # Skip the remaining commands and move to the next file
     fi
 
@@ -24,8 +24,6 @@ for bx_file in examples/*.bx; do
     gcc -o "$base_name.exe" "$base_name.x64-linux.s"
     if [ $? -ne 0 ]; then
         echo "Error: .exe not created, skipping further processing for $bx_file."
-        rm "$base_name.tac.json"
-        rm "$base_name.opt.tac.json"
         rm "$base_name.x64-linux.s"
         break
     fi
@@ -33,8 +31,6 @@ for bx_file in examples/*.bx; do
     output=$(./"$base_name.exe")
     # Check if an expected output file exists
     
-    rm "$base_name.tac.json"
-    rm "$base_name.opt.tac.json"
     rm "$base_name.x64-linux.s"
     rm "$base_name.exe"
 
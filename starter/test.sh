@@ -7,49 +7,49 @@ for bx_file in examples/*.bx; do
     b=$(basename "$bx_file" .bx)
     #echo "Processing $bx_file..."
 
-    # Run the first command
-    python3 bxc.py "$bx_file"
+    # every optimisation level must print the same expected output
+    for opt in 0 1 2; do
+        # Run the first command
+        python3 bxc.py -O$opt "$bx_file"
 
 
-    # Check if the required 'source.tac.json' file is created
-    if [ ! -f "$base_name.tac.json" ]; then
-        echo "Error: source.tac.json not created, skipping further processing for $bx_file."
-        continue  # Skip the remaining commands and move to the next file
-    fi
+        # Check if the required 'source.x64-linux.s' file is created
+        if [ ! -f "$base_name.x64-linux.s" ]; then
+            echo "Error: source.x64-linux.s not created, skipping further processing for $bx_file at -O$opt."
+            continue  # Skip the remaining commands and move to the next level
+        fi
 
-    # Run the remaining commands
-    gcc -c bxlib/bx_runtime.c -o bxlib/bx_runtime.o
+        # Run the remaining commands
+        gcc -c bxlib/bx_runtime.c -o bxlib/bx_runtime.o
 
-    gcc -o "$base_name.exe" "$base_name.x64-linux.s" bxlib/bx_runtime.o
+        gcc -o "$base_name.exe" "$base_name.x64-linux.s" bxlib/bx_runtime.o
 
     
-    # Capture the output of the executable into a variable
-    output=$(./"$base_name.exe")
+        # Capture the output of the executable into a variable
+        output=$(./"$base_name.exe")
 
-    # Check if an expected output file exists
-    if [ -f "expected/$b" ]; then
-        # Compare the actual output to the expected output
-        expected_output=$(cat "expected/$b")
+        # Check if an expected output file exists
+        if [ -f "expected/$b" ]; then
+            # Compare the actual output to the expected output
+            expected_output=$(cat "expected/$b")
         
-        if [ "$output" == "$expected_output" ]; then
-            echo "Success: Output for $bx_file is correct."
+            if [ "$output" == "$expected_output" ]; then
+                echo "Success: Output for $bx_file at -O$opt is correct."
+            else
+                echo "Error: Output for $bx_file at -O$opt does not match the expected output."
+                echo "Actual output:"
+                echo "$output"
+                echo "Expected output:"
+                echo "$expected_output"
+            fi
         else
-            echo "Error: Output for $bx_file does not match the expected output."
-            echo "Actual output:"
-            echo "$output"
-            echo "Expected output:"
-            echo "$expected_output"
+            echo "Warning: No expected output file found for $bx_file."
         fi
-    else
-        echo "Warning: No expected output file found for $bx_file."
-    fi
     
-    rm "$base_name.x64-linux.s"
-    rm "$base_name.s"
-    rm "$base_name.exe"
-    rm "$base_name.tac.json"
-    rm "$base_name.opt.tac.json"
-    rm "bxlib/bx_runtime.o"
+        rm "$base_name.x64-linux.s"
+        rm "$base_name.exe"
+        rm "bxlib/bx_runtime.o"
+    done
 
     #echo "$bx_file processed."
 done